@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+""" @package docstring
+Healthcheck benchmark
+
+Measures the cost of a healthcheck run on synthetic configs: 10, 100, 1000 checks (or any other size),
+with different shares of checks sharing the same command and different regexp complexity.
+The checks run fake commands (printing some lines of output, like a real sensor command would do)
+and the notifications are sent to a local stub SMTP server, so the results are reproducible.
+
+For every scenario, reports wall time, CPU time (including the commands), number of subprocesses,
+peak RSS and a breakdown of the time spent in every phase of the run. Every scenario runs in its
+own process, so the peak RSS of a scenario is not affected by the others.
+
+Usage:
+python3 benchmark.py                                     # runs all the scenarios
+python3 benchmark.py --sizes 100 --duplicates 0.5        # runs only some scenarios
+python3 benchmark.py --save baseline.json                # saves the results
+python3 benchmark.py --baseline baseline.json            # compares with saved results: exits with 1
+                                                         # if a scenario got slower than --tolerance
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import subprocess
+import socketserver
+import resource
+import itertools
+import logging
+
+
+NAME = 'benchmark'
+DESCRIPTION = 'Measures the cost of a healthcheck run on synthetic configs'
+DEFAULT_SIZES = [10, 100, 1000]
+DEFAULT_DUPLICATES = [0.0, 0.5, 0.9]
+DEFAULT_REGEXPS = ['simple', 'complex']
+# Lines printed by every fake command, before the line containing the value
+FAKE_OUTPUT_LINES = 20
+REGEXPS = {
+	'simple': r'value_{}: (\d+)',
+	'complex': r'^(?:\w+ )*value_{}:\s+(?:\+|-)?(\d+(?:[.,]\d+)?)(?:\s*(?:°C|RPM|%))?\s*$',
+}
+# Share of checks in alarm (they notify at every run)
+ALARM_SHARE = 0.1
+PHASES = ['config', 'settings', 'commands', 'parse', 'notify', 'status']
+
+
+class Main:
+
+	def __init__(self, args):
+		self.args = args
+
+	def run(self):
+		''' Runs every scenario in its own process and prints the results. Returns False on regression '''
+		scenarios = list(itertools.product(self.args.sizes, self.args.duplicates, self.args.regexps))
+		results = {}
+		for size, duplicates, regexp in scenarios:
+			key = '{}-{}-{}'.format(size, duplicates, regexp)
+			runs = [ self.runScenario(size, duplicates, regexp) for i in range(self.args.repeat) ]
+			# Report the fastest run: the others are slowed down by noise
+			results[key] = min(runs, key=lambda r: r['wall'])
+			self.printResult(key, results[key])
+
+		if self.args.save:
+			with open(self.args.save, 'w') as f:
+				json.dump(results, f, indent=1)
+
+		if self.args.baseline:
+			return self.compare(results)
+		return True
+
+	def runScenario(self, size, duplicates, regexp):
+		cmd = [ sys.executable, os.path.abspath(__file__), '--scenario', str(size), str(duplicates), regexp ]
+		if self.args.notify:
+			cmd.append('--notify')
+		ret = subprocess.run(cmd, stdout=subprocess.PIPE, check=True)
+		return json.loads(ret.stdout)
+
+	def printResult(self, key, r):
+		if not hasattr(self, 'headerPrinted'):
+			print('{:<20} {:>9} {:>9} {:>7} {:>9}  {}'.format('scenario', 'wall s', 'cpu s', 'forks', 'rss KB', '  '.join('{:>8}'.format(p) for p in PHASES)))
+			self.headerPrinted = True
+		print('{:<20} {:>9.3f} {:>9.3f} {:>7} {:>9}  {}'.format(
+			key, r['wall'], r['cpu'], r['subprocesses'], r['peakRss'],
+			'  '.join('{:>8.3f}'.format(r['phases'][p]) for p in PHASES)
+		))
+
+	def compare(self, results):
+		''' Compares the results with the baseline: returns False if any scenario is slower or forks more '''
+		with open(self.args.baseline, 'r') as f:
+			baseline = json.load(f)
+
+		ok = True
+		for key, r in results.items():
+			if key not in baseline:
+				continue
+			b = baseline[key]
+			if r['wall'] > b['wall'] * (1 + self.args.tolerance):
+				print('REGRESSION {}: wall time {:.3f}s, baseline {:.3f}s'.format(key, r['wall'], b['wall']))
+				ok = False
+			if r['subprocesses'] > b['subprocesses']:
+				print('REGRESSION {}: {} subprocesses, baseline {}'.format(key, r['subprocesses'], b['subprocesses']))
+				ok = False
+		return ok
+
+
+class Scenario:
+	''' A single benchmark run, executed in a dedicated process '''
+
+	def __init__(self, size, duplicates, regexp, notify):
+		self.size = size
+		self.duplicates = duplicates
+		self.regexp = regexp
+		self.notify = notify
+		self.phases = { p: 0.0 for p in PHASES }
+		self.subprocesses = 0
+
+	def run(self):
+		with tempfile.TemporaryDirectory() as tmpDir:
+			smtp = StubSmtpServer()
+			configPath = os.path.join(tmpDir, 'healthcheck.cfg')
+			self.writeConfig(configPath, smtp.port)
+
+			# Logs are formatted like in a real run with -q, but discarded
+			logging.basicConfig(level=logging.WARNING, stream=open(os.devnull, 'w'))
+			os.environ.setdefault('LANG', 'C.UTF-8')
+			sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+			import healthcheck
+			healthcheck.STATUS_FILE = os.path.join(tmpDir, 'healthcheck.tmp')
+			self.instrument(healthcheck)
+
+			startWall = time.perf_counter()
+			startCpu = os.times()
+			main = healthcheck.Main(configPath)
+			main.run(not self.notify)
+			endCpu = os.times()
+			wall = time.perf_counter() - startWall
+
+			smtp.shutdown()
+
+		# Phases are measured including the nested ones: make them exclusive
+		self.phases['config'] -= self.phases['settings']
+		self.phases['parse'] -= self.phases['commands']
+		self.phases['notify'] -= self.phases['parse'] + self.phases['commands']
+
+		return {
+			'wall': wall,
+			'cpu': sum(endCpu[i] - startCpu[i] for i in range(4)),
+			'subprocesses': self.subprocesses,
+			'peakRss': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+			'mails': smtp.received,
+			'phases': self.phases,
+		}
+
+	def writeConfig(self, path, smtpPort):
+		# The checks sharing the command use a small pool of commands
+		uniqueCommands = max(1, round(self.size * (1 - self.duplicates)))
+		lines = [
+			'[DEFAULT]',
+			'MAILTO=root@localhost',
+			'SMTPHOST=127.0.0.1:{}'.format(smtpPort),
+			'NOTIFY=EVERY_RUN',
+			'',
+		]
+		for i in range(self.size):
+			# Every command prints some noise lines and the values of all the checks using it
+			commandId = i % uniqueCommands
+			output = ''.join('noise line {}\\n'.format(n) for n in range(FAKE_OUTPUT_LINES))
+			output += ''.join('value_{}: {}\\n'.format(j, j) for j in range(commandId, self.size, uniqueCommands))
+			command = "printf '{}'".format(output)
+			inAlarm = i < self.size * ALARM_SHARE
+			lines += [
+				'[check_{}]'.format(i),
+				'COMMAND={}'.format(command),
+				'REGEXP={}'.format(REGEXPS[self.regexp].format(i)),
+				'ALARM_VALUE_MORE_THAN={}'.format(-1 if inAlarm else self.size),
+				'',
+			]
+		with open(path, 'w') as f:
+			f.write('\n'.join(lines))
+
+	def instrument(self, healthcheck):
+		''' Wraps the functions implementing the phases of a run, to measure them '''
+		self.timed(healthcheck.Main, 'loadConfig', 'config')
+		self.timed(healthcheck.Settings, '__init__', 'settings')
+		self.timed(healthcheck.CommandCache, 'execute', 'commands')
+		self.timed(healthcheck.Main, 'checkValue', 'parse')
+		self.timed(healthcheck.Main, 'runAndNotify', 'notify')
+		self.timed(healthcheck.Status, 'save', 'status')
+
+		scenario = self
+		originalInit = subprocess.Popen.__init__
+		def countingInit(self, *args, **kwargs):
+			scenario.subprocesses += 1
+			originalInit(self, *args, **kwargs)
+		subprocess.Popen.__init__ = countingInit
+
+	def timed(self, cls, methodName, phase):
+		original = getattr(cls, methodName)
+		lock = threading.Lock()
+		def wrapper(*args, **kwargs):
+			start = time.perf_counter()
+			try:
+				return original(*args, **kwargs)
+			finally:
+				with lock:
+					self.phases[phase] += time.perf_counter() - start
+		setattr(cls, methodName, wrapper)
+
+
+class StubSmtpServer:
+	''' A minimal SMTP server accepting (and discarding) every email, listening on the given local port
+	(a random one if 0) '''
+
+	def __init__(self, port=0):
+		stub = self
+		self.received = 0
+
+		class Handler(socketserver.StreamRequestHandler):
+			def handle(self):
+				self.wfile.write(b'220 stub ESMTP\r\n')
+				inData = False
+				for line in self.rfile:
+					if inData:
+						if line == b'.\r\n':
+							inData = False
+							stub.received += 1
+							self.wfile.write(b'250 OK\r\n')
+						continue
+					command = line[:4].upper()
+					if command == b'DATA':
+						inData = True
+						self.wfile.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+					elif command == b'QUIT':
+						self.wfile.write(b'221 Bye\r\n')
+						return
+					else:
+						self.wfile.write(b'250 OK\r\n')
+
+		self.server = socketserver.ThreadingTCPServer(('127.0.0.1', port), Handler)
+		self.server.daemon_threads = True
+		self.port = self.server.server_address[1]
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+	def shutdown(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		prog = NAME + '.py',
+		description = NAME + '\n' + DESCRIPTION,
+		formatter_class = argparse.RawTextHelpFormatter
+	)
+	parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help="number of checks of the configs")
+	parser.add_argument('--duplicates', type=float, nargs='+', default=DEFAULT_DUPLICATES, help="share of checks sharing the command with another one (0-1)")
+	parser.add_argument('--regexps', nargs='+', default=DEFAULT_REGEXPS, choices=list(REGEXPS), help="regexp complexity")
+	parser.add_argument('--repeat', type=int, default=3, help="runs of every scenario (the fastest is reported)")
+	parser.add_argument('--notify', action='store_true', help="send the notifications (to the stub SMTP server) instead of a dry run")
+	parser.add_argument('--save', metavar='FILE', help="save the results in this file")
+	parser.add_argument('--baseline', metavar='FILE', help="compare the results with the ones saved in this file")
+	parser.add_argument('--tolerance', type=float, default=0.2, help="with --baseline, max allowed slowdown (default 0.2 = 20%%)")
+	parser.add_argument('--scenario', nargs=3, help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.scenario:
+		# Internal: runs a single scenario and prints its results as json
+		size, duplicates, regexp = args.scenario
+		print(json.dumps(Scenario(int(size), float(duplicates), regexp, args.notify).run()))
+		sys.exit(0)
+
+	sys.exit(0 if Main(args).run() else 1)
@@ -38,6 +38,7 @@ import traceback
 import subprocess
 import configparser
 import time
+import datetime
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
 from email.mime.text import MIMEText
@@ -47,6 +48,26 @@ import getpass
 import re
 import locale
 import json
+import signal
+import threading
+import concurrent.futures
+import heapq
+import hashlib
+import hmac
+import contextlib
+import fcntl
+import mmap
+import struct
+import urllib.parse
+import collections
+import bisect
+import math
+import http.server
+import urllib.request
+import sqlite3
+import http.client
+import random
+import selectors
 
 
 NAME = 'healthcheck'
@@ -56,8 +77,48 @@ EMAIL_START_SUBJECT_TPL = '\U0001F6A8 {}: {} ALARM!'
 EMAIL_START_MESSAGE_TPL = 'Alarm for sensor {} on host {} on {}: {}'
 EMAIL_END_SUBJECT_TPL = '\u2705 {}: {} OK'
 EMAIL_END_MESSAGE_TPL = 'Alarm ceased for sensor {} on host {} on {}'
+EMAIL_DIGEST_SUBJECT_TPL = '\U0001F6A8 {}: {} alarm notifications'
 # Healthcheck saves the current status (alarms triggered, last run... in this file)
 STATUS_FILE = '/tmp/healthcheck.tmp'
+# A run started while the previous one is still running checks every these seconds if it ended
+RUN_LOCK_POLL_SECONDS = 1
+# In daemon mode, the config file is checked for changes at least once in this interval
+DAEMON_CONFIG_POLL_SECONDS = 5
+# Weight of the last run in the average duration of a check (exponentially weighted moving average)
+TIMING_EWMA_ALPHA = 0.2
+# The alarm raised when a check is slower than SLOW_THRESHOLD is named after the check, with this suffix
+SLOW_ALARM_SUFFIX = ' (slow)'
+# Outbox: delay before retrying a failed notification (doubled at every attempt, up to the max)
+OUTBOX_RETRY_SECONDS = 60
+OUTBOX_MAX_RETRY_SECONDS = 3600
+# Outbox: notifications that could not be sent within this time are dropped
+OUTBOX_EXPIRE_SECONDS = 7 * 86400
+# Max bytes of output read from a check command: when exceeded, the command is stopped
+OUTPUT_DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+# Bytes read from the command output at once
+OUTPUT_CHUNK_BYTES = 64 * 1024
+# Arguments of the ionice command for every IONICE value
+IONICE_ARGS = {
+	'idle': ['-c', '3'],
+	'best-effort': ['-c', '2', '-n', '7'],
+}
+# Cron mode: a check is run if due within these seconds, as the cron runs don't start exactly every minute
+CRON_SCHEDULE_SLACK_SECONDS = 10
+# Daemon mode: the outbox is flushed at least once in this interval
+OUTBOX_FLUSH_SECONDS = 30
+# Push mode: max time to wait for the collector response
+PUSH_TIMEOUT_SECONDS = 10
+# LCD display: min seconds between two updates of the display
+LCD_DEFAULT_MIN_INTERVAL = 5
+# Collector mode: default path of the database and default address to listen on
+COLLECTOR_DEFAULT_DB = '/var/lib/healthcheck/collector.db'
+COLLECTOR_DEFAULT_ADDRESS = '127.0.0.1:9870'
+# Addresses the collector can listen on without PUSH_TOKEN
+COLLECTOR_LOCAL_ADDRESSES = ('127.0.0.1', 'localhost')
+# Prefix of the env variables with the event details, passed to ALARM_COMMAND
+ALARM_COMMAND_ENV_PREFIX = 'HEALTHCHECK_'
+# History: number of values stored for every check (30 days of values detected every minute)
+HISTORY_DEFAULT_SAMPLES = 30 * 24 * 60
 
 class Main:
 
@@ -70,54 +131,439 @@ class Main:
 
 		locale.setlocale(locale.LC_ALL, systemLocale)
 
-		''' Reads the config '''
 		self._log = logging.getLogger('main')
 
 		if not os.path.exists(configPath) or not os.path.isfile(configPath):
 			raise ValueError('configPath must be a file')
 
-		self.config = configparser.ConfigParser(interpolation=None)	# Disable interpolation because contains regexp
-		self.config.read(configPath)
-		self.hostname = os.uname()[1]
-
-	def run(self, dryRun):
-		''' Runs the health checks '''
-
-		# Load status
-		status = Status()
-
-		# Run checks based o the config
-		for section in self.config:
+		self.configPath = configPath
+		self.exporter = None
+		self.store = None	# Collector mode only
+		self.notifyLimiter = None	# Collector mode only
+		self.remoteSettings = {}	# Collector mode only
+		self._settingsLock = threading.Lock()
+		self.identity = HostIdentity()
+		self.hostname = self.identity.nodename
+		self.loadConfig()
+
+	def loadConfig(self):
+		''' Reads the config and builds the settings of every check '''
+		config = configparser.ConfigParser(interpolation=None)	# Disable interpolation because contains regexp
+		configMtime = os.path.getmtime(self.configPath)
+		config.read(self.configPath)
+
+		checks = []
+		disabledChecks = []
+		for section in config:
 			if section == 'DEFAULT':
 				continue
 
-			s = Settings(section, self.config)
+			s = Settings(section, config, self.identity)
 			if s.disabled:
-				self._log.info('Ignoring disabled check "{}"'.format(section))
-				status.unsetAlarm(section)
-				continue
+				disabledChecks.append(section)
+			else:
+				checks.append(s)
 
-			self._log.info('Checking "{}"'.format(section))
+		outboxDir = config.get('DEFAULT', 'OUTBOX_DIR', fallback=None)
+		historyDir = config.get('DEFAULT', 'HISTORY_DIR', fallback=None)
+		historySamples = config.getint('DEFAULT', 'HISTORY_SAMPLES', fallback=HISTORY_DEFAULT_SAMPLES)
 
-			error = self.check(s)
-			if error:
-				# Alarm!
-				logging.warning('Alarm for {}: {}!'.format(section, error))
-				if self.shouldNotify(section, s, status):
-					status.setAlarm(section)
-					if not dryRun:
-						if s.mailto:
-							self.sendAlmStartMail(s, error)
-						if s.alarmCommand:
-							self.executeAlarmCommand(s, error)
-			elif status.getAlarmTriggeredTimestamp(section) is not None:
-				logging.info('Alarm ceased for {}: OK!'.format(section))
-				if s.notify_alarm_end and not dryRun and s.mailto:
-					self.sendAlmEndMail(s)
-				status.unsetAlarm(section)
-
-		# Save updated status
+		self.config = config
+		self.configMtime = configMtime
+		self.checks = checks
+		self.disabledChecks = disabledChecks
+		self.outbox = Outbox(outboxDir) if outboxDir else None
+		self.pushUrl = config.get('DEFAULT', 'PUSH_URL', fallback=None)
+		self.pushToken = config.get('DEFAULT', 'PUSH_TOKEN', fallback=None)
+		self.history = History(historyDir, historySamples) if historyDir else None
+		lcdUrl = config.get('DEFAULT', 'LCD_URL', fallback=None)
+		self.lcd = LcdDisplay(
+			lcdUrl,
+			config.getint('DEFAULT', 'LCD_WIDTH', fallback=16),
+			config.getint('DEFAULT', 'LCD_HEIGHT', fallback=2),
+			config.getfloat('DEFAULT', 'LCD_MIN_INTERVAL', fallback=LCD_DEFAULT_MIN_INTERVAL)
+		) if lcdUrl else None
+
+	def configChanged(self):
+		try:
+			return os.path.getmtime(self.configPath) != self.configMtime
+		except FileNotFoundError:
+			return False
+
+	def run(self, dryRun):
+		''' Runs the health checks '''
+
+		runLock = RunLock(STATUS_FILE)
+		if not runLock.acquire(wait=True):
+			self._log.warning('Skipping run: the previous one is still running')
+			return
+
+		try:
+			# Load status (only now, to get the changes made by the previous run)
+			status = Status()
+
+			self.ignoreDisabledChecks(status)
+			# Run only the checks whose INTERVAL has elapsed since their previous run
+			now = time.time()
+			due = []
+			for s in self.checks:
+				nextRun = status.getNextRun(s)
+				if nextRun <= now + CRON_SCHEDULE_SLACK_SECONDS:
+					due.append(s)
+				else:
+					self._log.debug('Skipping "{}": not due until {}'.format(s.name, datetime.datetime.fromtimestamp(nextRun)))
+			self.runAndNotify(due, status, dryRun)
+
+			# Save updated status
+			status.save()
+		finally:
+			runLock.release()
+
+		# Send the notifications only after saving the status: if something goes wrong,
+		# they are retried by the next run
+		if self.outbox and not dryRun:
+			self.flushOutbox()
+
+	def daemon(self, dryRun):
+		''' Runs the health checks forever, every one on its own INTERVAL.
+		The config is reloaded on SIGHUP or when the file changes '''
+
+		# The lock is kept as long as the daemon runs, so any run started by cron is skipped
+		runLock = RunLock(STATUS_FILE)
+		if not runLock.acquire(wait=False, daemon=True):
+			raise RuntimeError('another {} is already running with status file {}'.format(NAME, STATUS_FILE))
+
+		# Load status: it is kept in memory and saved after every run
+		status = Status()
+
+		self._wakeUp = threading.Event()
+		self._reloadRequested = False
+		self._stopRequested = False
+		signal.signal(signal.SIGHUP, self.onReloadSignal)
+		signal.signal(signal.SIGTERM, self.onStopSignal)
+		signal.signal(signal.SIGINT, self.onStopSignal)
+
+		self._log.info('Starting daemon with {} checks'.format(len(self.checks)))
+		self.ignoreDisabledChecks(status)
+		scheduler = Scheduler(self.checks, status)
+
+		# The metrics are served in background, from the results of the last runs
+		exporterAddress = self.config.get('DEFAULT', 'EXPORTER_ADDRESS', fallback=None)
+		if exporterAddress:
+			self.exporter = Exporter(exporterAddress)
+			self.exporter.start()
+
+		# The notifications in the outbox are sent in background, so the checks never wait for them
+		self._outboxWakeUp = threading.Event()
+		outboxWorker = threading.Thread(target=self.outboxWorker, name='outbox', daemon=True)
+		outboxWorker.start()
+
+		while not self._stopRequested:
+			if self._reloadRequested or self.configChanged():
+				self._reloadRequested = False
+				self._log.info('Reloading config {}'.format(self.configPath))
+				try:
+					self.loadConfig()
+				except Exception as e:
+					# Keep running with the previous config
+					self._log.error('Unable to reload config, keeping the previous one: {}'.format(e))
+					self.configMtime = os.path.getmtime(self.configPath)
+				else:
+					self.ignoreDisabledChecks(status)
+					status.retainAlarms(self.checks)
+					if self.exporter:
+						self.exporter.retain(self.checks)
+						self.exporter.publish()
+					scheduler = Scheduler(self.checks, status)
+
+			due = scheduler.popDue(time.time())
+			if due:
+				try:
+					self.runAndNotify(due, status, dryRun)
+				except Exception:
+					self._log.error(traceback.format_exc())
+				status.save()
+				scheduler.reschedule(due, time.time(), status)
+				if self.outbox and not dryRun:
+					self._outboxWakeUp.set()
+
+			# Sleep until the next check is due (or a signal is received), but wake up
+			# from time to time to look for config changes
+			wait = min(scheduler.nextDue() - time.time(), DAEMON_CONFIG_POLL_SECONDS)
+			if wait > 0:
+				self._wakeUp.wait(wait)
+			self._wakeUp.clear()
+
+		self._log.info('Daemon stopped')
 		status.save()
+		if self.exporter:
+			self.exporter.stop()
+		self._outboxWakeUp.set()
+		outboxWorker.join(DAEMON_CONFIG_POLL_SECONDS)
+		runLock.release()
+
+	def onReloadSignal(self, signum, frame):
+		self._reloadRequested = True
+		self._wakeUp.set()
+
+	def onStopSignal(self, signum, frame):
+		self._stopRequested = True
+		self._wakeUp.set()
+
+	def ignoreDisabledChecks(self, status):
+		for section in self.disabledChecks:
+			self._log.info('Ignoring disabled check "{}"'.format(section))
+			for almName in status.getAlarmNames(section):
+				status.unsetAlarm(almName)
+
+	def runAndNotify(self, checks, status, dryRun):
+		''' Runs the checks (concurrently, if MAX_PARALLEL > 1), updates the status and sends the notifications.
+		The results are always processed in config order, so notifications are deterministic. '''
+		started = time.time()
+		results = self.runChecks(checks, status)
+
+		# Notification emails are collected and sent together at the end
+		self.mailBatch = MailBatch(self.hostname)
+
+		now = time.time()
+		sensors = []	# tuples (sensor name, result) of all the checks and their sub-sensors
+		for s, result in zip(checks, results):
+			section = s.name
+			sensors.append((section, result))
+			self.updateSensor(s, section, None, result, status, dryRun, now)
+			if result.sensors is not None:
+				# Sub-sensors are named after the check, with the sub-sensor name in square brackets
+				names = set()
+				for sub, subResult in result.sensors:
+					name = '{}[{}]'.format(section, sub)
+					names.add(name)
+					sensors.append((name, subResult))
+					self.updateSensor(s, name, sub, subResult, status, dryRun, now)
+				for almName in status.getAlarmNames(section):
+					if almName.startswith(section + '[') and almName not in names:
+						# Not detected anymore (e.g. a disk removed, with MATCH_ALL)
+						self._log.info('Forgetting alarm for {}: not detected anymore'.format(almName))
+						status.unsetAlarm(almName)
+
+			avgDuration = status.updateTiming(section, result, now)
+			if s.slow_threshold is not None:
+				# Compared with the average, so a single slow run doesn't raise the alarm
+				slowError = None
+				if avgDuration > s.slow_threshold:
+					slowError = 'the check takes {:.2f} seconds on average, more than {} seconds'.format(avgDuration, s.slow_threshold)
+				self.updateAlarm(s, section + SLOW_ALARM_SUFFIX, slowError, status, dryRun, self.hostname)
+
+			# A slow check in alarm must not run more often
+			inAlarm = any(not almName.endswith(SLOW_ALARM_SUFFIX) for almName in status.getAlarmNames(section))
+			status.updateSchedule(s, started, inAlarm)
+
+		if self.exporter:
+			self.exporter.publish()
+
+		# Before sending the emails, that may wait for a slow SMTP server
+		if self.pushUrl:
+			self.pushResults(sensors)
+
+		if self.lcd:
+			self.lcd.publish(status, self.hostname)
+
+		try:
+			self.mailBatch.send()
+		except Exception:
+			pass	# Already logged by MailBatch: the status must be saved anyway
+		# The alarms whose email was not sent are restored as they were before the run, so they are
+		# notified again by the next run
+		for tag in self.mailBatch.failedTags:
+			if tag is not None:
+				status.restoreAlarm(*tag)
+
+	def updateSensor(self, s, name, sub, result, status, dryRun, now):
+		''' Processes the result of a check, or of one of its sub-sensors: stores the value,
+		compares the aggregate if needed, updates the alarm and sends the notifications '''
+		if self.history and result.value is not None:
+			self.history.append(name, now, result.value)
+		windowFilling = False
+		if s.aggregate and result.value is not None:
+			# Compare the aggregate of the last WINDOW values instead of the detected one
+			window = status.getWindow(name, s.window)
+			result.error = self.compareAggregate(s, window, result.value, sub)
+			windowFilling = result.error is None and len(window) < s.window
+
+		if self.exporter:
+			self.exporter.update(name, result, now)
+
+		if windowFilling:
+			# Not enough values to compare yet: the alarm (if any) is left as it is
+			return
+		self.updateAlarm(s, name, result.error, status, dryRun, self.hostname)
+
+	def updateAlarm(self, s, name, error, status, dryRun, hostname):
+		''' Updates the alarm status of a check and sends the alarm start/end notifications '''
+		if error:
+			# Alarm!
+			logging.warning('Alarm for {}: {}!'.format(name, error))
+			if self.shouldNotify(name, s, status):
+				if self.notifyLimiter and not self.notifyLimiter.allow():
+					# Not recorded as notified: will be notified when the rate allows it
+					logging.warning('Notifications rate limit exceeded: alarm for {} not notified'.format(name))
+					return
+				previous = status.getAlarmTriggeredTimestamp(name)
+				status.setAlarm(name)
+				if not dryRun:
+					if s.mailto:
+						self.sendAlmStartMail(s, name, error, hostname, (name, previous))
+					if s.alarmCommand:
+						self.executeAlarmCommand(s, name, error, hostname)
+		elif status.getAlarmTriggeredTimestamp(name) is not None:
+			logging.info('Alarm ceased for {}: OK!'.format(name))
+			if s.notify_alarm_end and not dryRun and s.mailto:
+				if self.notifyLimiter and not self.notifyLimiter.allow():
+					logging.warning('Notifications rate limit exceeded: alarm end for {} not notified'.format(name))
+				else:
+					self.sendAlmEndMail(s, name, hostname, (name, status.getAlarmTriggeredTimestamp(name)))
+			status.unsetAlarm(name)
+
+	def pushResults(self, sensors):
+		''' Sends the results (list of tuples sensor name, result) to the central collector (see collector()) '''
+		payload = json.dumps({
+			'host': self.hostname,
+			'time': time.time(),
+			'results': [ { 'check': name, 'value': r.value, 'error': r.error } for name, r in sensors ],
+		}).encode()
+		headers = { 'Content-Type': 'application/json', 'User-Agent': NAME + ' ' + VERSION }
+		if self.pushToken:
+			headers['Authorization'] = 'Bearer ' + self.pushToken
+		try:
+			urllib.request.urlopen(urllib.request.Request(self.pushUrl, data=payload, headers=headers), timeout=PUSH_TIMEOUT_SECONDS).close()
+		except OSError as e:
+			self._log.error('Unable to push results to {}: {}'.format(self.pushUrl, e))
+
+	def collector(self, dryRun):
+		''' Runs as central collector: receives the results pushed by the other hosts (PUSH_URL) and sends the
+		notifications, using the notification settings in this config (DEFAULT section, or the section with
+		the same name of the remote check). The alarms status of all the hosts is kept in a sqlite database '''
+		address = self.config.get('DEFAULT', 'COLLECTOR_ADDRESS', fallback=COLLECTOR_DEFAULT_ADDRESS)
+		dbPath = self.config.get('DEFAULT', 'COLLECTOR_DB', fallback=COLLECTOR_DEFAULT_DB)
+		maxNotifications = self.config.getint('DEFAULT', 'COLLECTOR_MAX_NOTIFICATIONS_PER_MINUTE', fallback=0)
+
+		self.store = CollectorStore(dbPath)
+		if maxNotifications > 0:
+			self.notifyLimiter = RateLimiter(maxNotifications, 60)
+		self.collectorDryRun = dryRun
+		self._collectorLock = threading.Lock()
+
+		# The notifications in the outbox are sent in background
+		self._stopRequested = False
+		self._outboxWakeUp = threading.Event()
+		threading.Thread(target=self.outboxWorker, name='outbox', daemon=True).start()
+
+		host, _, port = address.rpartition(':')
+		host = host or '0.0.0.0'
+		if not self.pushToken and host not in COLLECTOR_LOCAL_ADDRESSES:
+			# The pushed results end up in the notifications and in ALARM_COMMAND
+			raise ValueError('PUSH_TOKEN is required when the collector listens on {}'.format(host))
+		server = http.server.ThreadingHTTPServer((host, int(port)), CollectorRequestHandler)
+		server.daemon_threads = True
+		server.main = self
+		self._log.info('Collector listening on {}'.format(address))
+		try:
+			server.serve_forever()
+		finally:
+			self._stopRequested = True
+			self._outboxWakeUp.set()
+			server.server_close()
+
+	def collectResults(self, batch):
+		''' Collector: processes a batch of results pushed by a host, returns the number of processed results '''
+		hostname = str(batch['host'])
+		with self._collectorLock:
+			hostStatus = self.store.getHostStatus(hostname)
+			if batch['time'] <= hostStatus.lastPush:
+				# Already received (e.g. resent after a timeout) or older than the last one
+				self._log.info('Ignoring outdated batch from {}'.format(hostname))
+				return 0
+			hostStatus.lastPush = batch['time']
+
+			mailBatch = self.mailBatch = MailBatch(self.hostname)
+			for r in batch['results']:
+				# Sub-sensors use the settings of their check
+				name = str(r['check'])
+				s = self.getSettings(Status.getCheckName(name))
+				hostStatus.setValue(name, r['value'], r['error'])
+				if s is None:
+					# Disabled on the collector: stored, but never notified
+					hostStatus.unsetAlarm(name)
+					continue
+				self.updateAlarm(s, name, r['error'], hostStatus, self.collectorDryRun, hostname)
+			self.store.save(hostStatus)
+
+		# Sent without holding the lock, so a slow SMTP server doesn't block the pushes of the other hosts
+		try:
+			mailBatch.send()
+		except Exception:
+			pass	# Already logged by MailBatch: the batch is accepted anyway
+		if mailBatch.failedTags:
+			# The alarms whose email was not sent are restored as they were before the batch, so they are
+			# notified again by the next push
+			with self._collectorLock:
+				hostStatus = self.store.getHostStatus(hostname)
+				for tag in mailBatch.failedTags:
+					if tag is not None:
+						hostStatus.restoreAlarm(*tag)
+				self.store.save(hostStatus)
+		if self.outbox and not self.collectorDryRun:
+			self._outboxWakeUp.set()
+		return len(batch['results'])
+
+	def getSettings(self, name):
+		''' Returns the settings of a check, or None if it is disabled. The collector builds the settings for the remote
+		checks on the fly, based on the section with the same name if present, or the DEFAULT section '''
+		for s in self.checks:
+			if s.name == name:
+				return s
+		if name in self.disabledChecks:
+			return None
+		with self._settingsLock:
+			if name not in self.remoteSettings:
+				if not self.config.has_section(name):
+					self.config.add_section(name)
+				self.remoteSettings[name] = Settings(name, self.config, self.identity)
+			return self.remoteSettings[name]
+
+	def runChecks(self, checks, status):
+		''' Runs the checks, using up to MAX_PARALLEL threads, and returns the results in the same order '''
+		# Commands shared by multiple checks are executed only once per run
+		self.commandCache = CommandCache(checks)
+
+		maxParallel = self.config.getint('DEFAULT', 'MAX_PARALLEL', fallback=1)
+		if maxParallel <= 1 or len(checks) <= 1:
+			return [ self.check(s, status) for s in checks ]
+
+		with concurrent.futures.ThreadPoolExecutor(max_workers=maxParallel) as executor:
+			return list(executor.map(lambda s: self.check(s, status), checks))
+
+	def printHistory(self, section, since, until):
+		''' Prints the values detected by a check between the two unix times '''
+		if not self.history:
+			raise ValueError('HISTORY_DIR is not configured')
+		for timestamp, value in self.history.query(section, since, until):
+			# Values are stored as float32: print only the significant digits
+			print('{}\t{}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)), locale.format_string('%g', value)))
+
+	def printProfile(self):
+		''' Prints the timings of the checks saved in the status, slowest first '''
+		timings = Status().getTimings()
+		print('{:<30} {:>9} {:>9} {:>5} {:>10} {:>9}  {}'.format('check', 'last s', 'avg s', 'exit', 'out bytes', 'regexp ms', 'last run'))
+		for name, t in sorted(timings.items(), key=lambda item: item[1]['duration'], reverse=True):
+			print('{:<30} {:>9.3f} {:>9.3f} {:>5} {:>10} {:>9}  {}'.format(
+				name,
+				t['duration'],
+				t['avgDuration'],
+				'-' if t['exitCode'] is None else t['exitCode'],
+				'-' if t['outputBytes'] is None else t['outputBytes'],
+				'-' if t['regexpTime'] is None else '{:.3f}'.format(t['regexpTime'] * 1000),
+				time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t['timestamp']))
+			))
 
 	def shouldNotify(self, section, settings, status):
 		almTriggeredTime = status.getAlarmTriggeredTimestamp(section)
@@ -135,125 +581,1242 @@ class Main:
 
 		return False
 
-	# Calls the provided command, checks the value parsing it with the provided regexp
-	# and returns an error string, or null if the value is within its limits
-	def check(self, config):
+	# Obtains the value (from the collector or the command output) and checks it:
+	# returns a CheckResult, whose error is null if the value is within its limits
+	def check(self, config, status):
+		result = CheckResult(None, None)
+		startTime = time.monotonic()
+		result.value, result.error = self.checkValue(config, result, status)
+		result.duration = time.monotonic() - startTime
+		return result
+
+	# Returns a tuple (detected value, error string). The command statistics are stored in the result
+	def checkValue(self, config, result, status):
+		self._log.info('Checking "{}"'.format(config.name))
+
+		if config.logfile:
+			# Count the lines matching the regexp, among the ones appended since the last run
+			try:
+				count, position = LogFile.countMatches(config.logfile, config.regexp, status.getLogPosition(config.name))
+			except OSError as e:
+				return None, 'unable to read {}: {}'.format(config.logfile, e)
+			status.setLogPosition(config.name, position)
+			detectedValue = str(count)
+		elif config.collector:
+			# Read the value directly from the system, without running any command
+			try:
+				detectedValue = Collectors.collect(config.collector, config.collector_arg)
+			except (OSError, ValueError) as e:
+				return None, 'unable to read {}: {}'.format(config.collector, e)
+		else:
+			detectedValue, error = self.readCommandValue(config, result)
+			if error:
+				return None, error
+
+		if isinstance(detectedValue, dict):
+			# Every sub-sensor is compared with its own thresholds
+			result.sensors = []
+			for sub, value in detectedValue.items():
+				if value is None:
+					error = 'regexp group "{}" didn\'t match anything'.format(sub)
+				elif config.aggregate:
+					error = None
+				else:
+					error = self.compare(config, value, sub)
+				result.sensors.append((sub, CheckResult(value, error)))
+			return None, None
+
+		if config.aggregate:
+			# Compared later with the previous values (see compareAggregate)
+			return detectedValue, None
+		return detectedValue, self.compare(config, detectedValue)
+
+	# Calls the provided command and parses its output with the provided regexp.
+	# Returns a tuple (detected value, error string). Exit code, output size and regexp time are stored in the result
+	def readCommandValue(self, config, result):
 		# Check config
 		if not config.command:
-			return "bad config: COMMAND is mandatory"
-		if not config.regexp:
-			return "bad config: REGEXP is mandatory"
+			return None, "bad config: COMMAND, COLLECTOR or LOGFILE is mandatory"
 
-		# Run command
+		# Run command (or reuse its output, if already executed in this run)
 		stdout = ""
-		ret = subprocess.run(config.command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+		try:
+			ret = self.commandCache.run(config)
+		except subprocess.TimeoutExpired:
+			return None, 'the command did not complete within {} seconds and was killed'.format(config.timeout)
+		result.exitCode = ret.returncode
+		result.outputBytes = len(ret.stdout or b'') + len(ret.stderr or b'')
 		if ret.stderr:
-			self._log.info('{} subprocess stderr:\n{}'.format(config.command, ret.stderr.decode()))
+			self._log.info('{} subprocess stderr:\n{}'.format(config.command, ret.stderr.decode(errors='replace')))
 		if ret.stdout:
-			stdout = ret.stdout.decode()
+			stdout = ret.stdout.decode(errors='replace')
 			self._log.debug('{} subprocess stdout:\n{}'.format(config.command, stdout))
-		if ret.returncode != 0:
-			return 'the command exited with error code {} {}'.format(
+		if ret.stopReason == 'truncated':
+			self._log.warning('{} output exceeded MAX_OUTPUT_BYTES: the command was stopped'.format(config.command))
+		elif ret.stopReason is None and ret.returncode != 0:
+			# When stopped, the exit code is not meaningful
+			return None, 'the command exited with error code {} {}'.format(
 				ret.returncode,
-				'and error message "{}"'.format(ret.stderr.decode().strip()) if ret.stderr else ''
+				'and error message "{}"'.format(ret.stderr.decode(errors='replace').strip()) if ret.stderr else ''
 			)
 
 		# Parse result with regex
-		match = re.search(config.regexp, stdout, re.MULTILINE)
+		regexpStartTime = time.monotonic()
+		try:
+			value, error = self.parseOutput(config, stdout)
+		finally:
+			result.regexpTime = time.monotonic() - regexpStartTime
+		if error and ret.stopReason == 'truncated':
+			error += ' in the first {} bytes of output'.format(len(ret.stdout))
+		return value, error
+
+	# Applies the regexp to the command output. Returns a tuple (detected value, error string): for checks
+	# with sub-sensors, the detected value is a dict sub-sensor name : value
+	def parseOutput(self, config, stdout):
+		if config.match_all:
+			# Every match is a sub-sensor, named after the "name" group (or its position, if missing)
+			values = {}
+			hasName = 'name' in config.regexp.groupindex
+			for i, match in enumerate(config.regexp.finditer(stdout)):
+				values[match.group('name') if hasName else str(i)] = match.group('value')
+			if not values:
+				return None, 'regexp didn\'t match anything'
+			return values, None
+
+		match = config.regexp.search(stdout)
 		if not match:
-			return 'regexp didn\'t match anything'
+			return None, 'regexp didn\'t match anything'
+		if config.regexp.groupindex:
+			# Every named group is a sub-sensor
+			return match.groupdict(), None
 		groups = match.groups()
 		if len(groups) != 1:
-			return 'regexp returns {} groups (expected exactly 1 group)'.format(len(matches))
-		detectedValue = groups[0]
-
-		# Compare detected value with equal, not equal, more than and less values
-		logging.info('detected {}'.format(detectedValue))
-		if config.alarm_string_equal and (detectedValue == config.alarm_string_equal):
-			return 'value is "{}"'.format(detectedValue)
-		if config.alarm_string_not_equal and (detectedValue != config.alarm_string_not_equal):
-			return 'value is "{}", but should be "{}"'.format(detectedValue, config.alarm_string_not_equal)
-		if config.alarm_value_equal and (locale.atof(detectedValue) == float(config.alarm_value_equal)):
-			return 'value is {}'.format(detectedValue)
-		if config.alarm_value_not_equal and (locale.atof(detectedValue) != float(config.alarm_value_not_equal)):
-			return 'value is {}, but should be {}'.format(detectedValue, config.alarm_value_not_equal)
-		if config.alarm_value_more_than and locale.atof(detectedValue) > float(config.alarm_value_more_than):
-			return 'value is {}, but should not exceed {}'.format(locale.atof(detectedValue), config.alarm_value_more_than)
-		if config.alarm_value_less_than and locale.atof(detectedValue) < float(config.alarm_value_less_than):
-			return 'value is {}, but should be greater than {}'.format(locale.atof(detectedValue), config.alarm_value_less_than)
-
-	def sendAlmStartMail(self, s, error):
-		subject = EMAIL_START_SUBJECT_TPL.format(self.hostname, s.name)
+			return None, 'regexp returns {} groups (expected exactly 1 group)'.format(len(groups))
+		return groups[0], None
+
+	# Checks the detected value against the configured limits: returns an error string,
+	# or null if the value is within its limits
+	def compare(self, config, detectedValue, sub=None):
+		if sub is None:
+			logging.info('detected {}'.format(detectedValue))
+		else:
+			logging.info('detected {} for {}'.format(detectedValue, sub))
+		return config.getComparator(sub)(detectedValue)
+
+	def compareAggregate(self, config, window, detectedValue, sub=None):
+		''' Adds the detected value to the window of the last values and compares the aggregate (avg, max...)
+		with the configured limits: returns an error string, or null if the aggregate is within its limits '''
+		try:
+			window.push(locale.atof(detectedValue))
+		except ValueError:
+			return 'value "{}" is not a number'.format(detectedValue)
+
+		if len(window) < config.window:
+			# A single spike would raise the alarm, until the window is full
+			logging.info('detected {}, {} values of {} needed to compare the {}'.format(detectedValue, len(window), config.window, config.aggregate))
+			return None
+
+		aggregate = window.aggregate(config.aggregate)
+		logging.info('detected {}, {} of last {} values is {}'.format(detectedValue, config.aggregate, len(window), aggregate))
+		error = config.getComparator(sub)(locale.str(aggregate))
+		if error:
+			return '{} of last {} values: {}'.format(config.aggregate, len(window), error)
+
+	def sendAlmStartMail(self, s, name, error, hostname, tag=None):
+		subject = EMAIL_START_SUBJECT_TPL.format(hostname, name)
 		body = EMAIL_START_MESSAGE_TPL.format(
-			s.name,
-			self.hostname,
+			name,
+			hostname,
 			time.strftime("%a, %d %b %Y %H:%M:%S"),
 			error
 		)
-		self.sendMail(s, subject, body)
+		self.sendMail(s, subject, body, hostname, tag)
 
-	def sendAlmEndMail(self, s):
-		subject = EMAIL_END_SUBJECT_TPL.format(self.hostname, s.name)
+	def sendAlmEndMail(self, s, name, hostname, tag=None):
+		subject = EMAIL_END_SUBJECT_TPL.format(hostname, name)
 		body = EMAIL_END_MESSAGE_TPL.format(
-			s.name,
-			self.hostname,
+			name,
+			hostname,
 			time.strftime("%a, %d %b %Y %H:%M:%S")
 		)
-		self.sendMail(s, subject, body)
+		self.sendMail(s, subject, body, hostname, tag)
+
+	def sendMail(self, s, subject, body, hostname, tag=None):
+		''' The tag (alarm name, alarm triggered timestamp before the run) is used to restore the alarm status
+		if the email can't be sent '''
+		if self.outbox:
+			# Sent later by the outbox flush
+			self.outbox.add({ 'type': 'mail', 'section': s.name, 'host': hostname, 'subject': subject, 'body': body })
+			return
+		# The mails are sent all together at the end of the run
+		self.mailBatch.add(s, subject, body, tag)
+
+	def executeAlarmCommand(self, s, name, error, hostname):
+		# The values (that the collector receives from the network) are never pasted into the command:
+		# the placeholders become quoted references to environment variables, expanded by the shell
+		variables = {
+			'CHECKNAME': name,
+			'HOSTNAME': hostname,
+			'DATETIME': time.strftime("%a, %d %b %Y %H:%M:%S"),
+			'ERROR': error,
+		}
+		cmdToRun = s.alarmCommand
+		for placeholder in variables:
+			cmdToRun = cmdToRun.replace('%%{}%%'.format(placeholder), '"${{{}{}}}"'.format(ALARM_COMMAND_ENV_PREFIX, placeholder))
+		env = { ALARM_COMMAND_ENV_PREFIX + k: v for k, v in variables.items() }
+
+		if self.outbox:
+			# Executed later by the outbox flush
+			self.outbox.add({ 'type': 'command', 'section': s.name, 'alarm': name, 'host': hostname, 'command': cmdToRun, 'env': env })
+			return
+		self.runAlarmCommand(cmdToRun, env)
+
+	def runAlarmCommand(self, cmdToRun, env=None):
+		''' Runs the alarm command, with the event details in the env variables. Returns True if it succeeded '''
+		logging.debug("Executing alarm command %s with %s", cmdToRun, env)
+
+		ret = subprocess.run(cmdToRun, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, env=dict(os.environ, **(env or {})))
+		if ret.stderr:
+			self._log.info('{} subprocess stderr:\n{}'.format(cmdToRun, ret.stderr.decode()))
+		if ret.stdout:
+			stdout = ret.stdout.decode()
+			self._log.debug('{} subprocess stdout:\n{}'.format(cmdToRun, stdout))
+		if ret.returncode != 0:
+			self._log.error('subprocess {} exited with error code {}'.format(cmdToRun, ret.returncode))
+			return False
+		return True
+
+	def flushOutbox(self):
+		''' Sends the pending notifications in the outbox. The ones that fail are retried later, with exponential backoff '''
+		if not self.outbox:
+			raise ValueError('OUTBOX_DIR is not configured')
+
+		with self.outbox.lock() as locked:
+			if not locked:
+				self._log.info('Outbox is already being flushed by another process')
+				return
+
+			entries = self.outbox.due(time.time())
+			if not entries:
+				return
+			self._log.info('Flushing {} notifications from outbox'.format(len(entries)))
+
+			settingsByName = { s.name: s for s in self.checks }
+			if self.store:
+				# Collector: the notifications are for remote checks
+				settingsByName = { entry['section']: self.getSettings(entry['section']) for entry in entries }
+				settingsByName = { name: s for name, s in settingsByName.items() if s is not None }
+			mailBatch = MailBatch(self.hostname)
+			for entry in entries:
+				s = settingsByName.get(entry['section'])
+				if s is None:
+					# Check removed or disabled since the notification was created
+					self._log.warning('Dropping notification for unknown check {}'.format(entry['section']))
+					self.outbox.remove(entry)
+				elif entry['type'] == 'mail':
+					mailBatch.add(s, entry['subject'], entry['body'], entry)
+				elif self.runAlarmCommand(entry['command'], entry.get('env')):
+					self.outbox.remove(entry)
+				else:
+					self.outbox.retryLater(entry)
+
+			try:
+				mailBatch.send()
+			except Exception:
+				pass	# Already logged by MailBatch, failed mails are retried
+			for entry in entries:
+				if entry['type'] != 'mail' or entry['section'] not in settingsByName:
+					continue
+				if entry in mailBatch.failedTags:
+					self.outbox.retryLater(entry)
+				else:
+					self.outbox.remove(entry)
+
+	def outboxWorker(self):
+		''' Daemon mode: flushes the outbox in background, when notified of new entries or every OUTBOX_FLUSH_SECONDS '''
+		while not self._stopRequested:
+			try:
+				if self.outbox:
+					self.flushOutbox()
+			except Exception:
+				self._log.error(traceback.format_exc())
+			self._outboxWakeUp.wait(OUTBOX_FLUSH_SECONDS)
+			self._outboxWakeUp.clear()
+
+
+class CheckResult:
+	''' The outcome of a check: the detected value (None if it couldn't be obtained), the error (None if not in alarm),
+	the time taken by the check, in seconds, and the statistics of its command (None for collectors).
+	A check with sub-sensors has their results in sensors, as a list of tuples (sub-sensor name, CheckResult) '''
+
+	__slots__ = ('value', 'error', 'duration', 'exitCode', 'outputBytes', 'regexpTime', 'sensors')
+
+	def __init__(self, value, error):
+		self.value = value
+		self.error = error
+		self.duration = 0.0
+		self.exitCode = None
+		self.outputBytes = None
+		self.regexpTime = None
+		self.sensors = None
+
+
+class LcdDisplay:
+	''' Shows a summary of the status on the esp32-lcd display: the number of alarms and the sensors in alarm
+	(oldest first), paged over the display lines, a page per run. The display is updated only when the text
+	changes, no more than once every LCD_MIN_INTERVAL seconds, reusing the same connection '''
+
+	def __init__(self, url, width, height, minInterval):
+		parsed = urllib.parse.urlsplit(url)
+		self.host = parsed.hostname
+		self.port = parsed.port or 80
+		self.path = parsed.path or '/'
+		self.width = width
+		self.height = height
+		self.minInterval = minInterval
+		self.connection = None
+
+	def render(self, hostname, alarms, page):
+		''' Returns the text of a page (width x height characters: the display prints width characters
+		per line) and the number of pages '''
+		if not alarms:
+			lines = [ 'ALL OK', hostname ]
+			pages = 1
+		else:
+			# The first line of every page is the header, the others list the alarms
+			perPage = max(self.height - 1, 1)
+			pages = math.ceil(len(alarms) / perPage)
+			page = page % pages
+			header = '{} ALARM{}'.format(len(alarms), 'S' if len(alarms) > 1 else '')
+			if pages > 1:
+				counter = '{}/{}'.format(page + 1, pages)
+				header = header[:self.width - len(counter) - 1].ljust(self.width - len(counter)) + counter
+			lines = [ header ] + alarms[page * perPage:(page + 1) * perPage]
+			if self.height == 1:
+				lines = lines[1:]
+		# The display supports only ascii characters
+		text = ''.join(line[:self.width].ljust(self.width) for line in lines[:self.height])
+		return text.ljust(self.width * self.height).encode('ascii', errors='replace').decode(), pages
+
+	def publish(self, status, hostname):
+		state = status.getDisplayState()
+		page = state.get('page', 0)
+		alarms = [ name for name, timestamp in sorted(status.getAlarms().items(), key=lambda item: item[1]) ]
+		text, pages = self.render(hostname, alarms, page)
+		state['page'] = (page + 1) % pages
+
+		if text == state.get('text'):
+			return
+		if time.time() - state.get('time', 0) < self.minInterval:
+			# Sent by one of the next runs, if still changed
+			logging.debug('LCD update postponed: updated less than {} seconds ago'.format(self.minInterval))
+			return
+		if self.send(text):
+			state['text'] = text
+			state['time'] = time.time()
+
+	def send(self, text):
+		''' Sends the text to the display, returns True if succeeded '''
+		url = '{}?{}'.format(self.path, urllib.parse.urlencode({ 'message': text }))
+		for attempt in range(2):
+			if not self.connection:
+				self.connection = http.client.HTTPConnection(self.host, self.port, timeout=PUSH_TIMEOUT_SECONDS)
+			try:
+				self.connection.request('GET', url, headers={ 'User-Agent': NAME + ' ' + VERSION })
+				response = self.connection.getresponse()
+				response.read()
+			except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError) as e:
+				# The kept-alive connection was closed by the display: retry once with a new one
+				self.close()
+				if attempt == 0:
+					continue
+				logging.error('Unable to update LCD {}: {}'.format(self.host, e))
+				return False
+			except (OSError, http.client.HTTPException) as e:
+				self.close()
+				logging.error('Unable to update LCD {}: {}'.format(self.host, e))
+				return False
+
+			if response.will_close:
+				self.close()
+			if response.status != 200:
+				logging.error('Unable to update LCD {}: http status {}'.format(self.host, response.status))
+				return False
+			logging.debug('LCD updated')
+			return True
+		return False
+
+	def close(self):
+		if self.connection:
+			self.connection.close()
+			self.connection = None
+
+
+class Exporter:
+	''' Daemon mode: serves the last results of the checks on http, in Prometheus text format.
+	The page is rendered by the check loop after every run, so a scrape never runs any check '''
+
+	def __init__(self, address):
+		host, _, port = address.rpartition(':')
+		self.results = {}	# key-value, check name : (value, inAlarm, duration, timestamp)
+		self.page = b''
+		self.server = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), self.handlerClass())
+		self.server.daemon_threads = True
+
+	def start(self):
+		logging.info('Serving metrics on http://%s:%d/metrics', *self.server.server_address[:2])
+		threading.Thread(target=self.server.serve_forever, name='exporter', daemon=True).start()
+
+	def stop(self):
+		self.server.shutdown()
+
+	def update(self, name, result, timestamp):
+		try:
+			value = locale.atof(result.value) if result.value is not None else None
+		except ValueError:
+			value = None	# Only numeric values can be exported
+		self.results[name] = (value, result.error is not None, result.duration, timestamp)
+
+	def retain(self, checks):
+		''' Forgets the results of the checks not present anymore in the config '''
+		names = set(s.name for s in checks)
+		self.results = { name: r for name, r in self.results.items() if Status.getCheckName(name) in names }
+
+	def publish(self):
+		''' Renders the page served to the next scrapes '''
+		metrics = (
+			('healthcheck_value', 'gauge', 'Last value detected by the check', lambda r: r[0]),
+			('healthcheck_alarm', 'gauge', 'Whether the check is in alarm (1) or not (0)', lambda r: int(r[1])),
+			('healthcheck_check_duration_seconds', 'gauge', 'Time taken by the last execution of the check', lambda r: r[2]),
+			('healthcheck_last_run_timestamp_seconds', 'gauge', 'Unix time of the last execution of the check', lambda r: r[3]),
+		)
+		lines = []
+		for metric, metricType, description, getter in metrics:
+			lines.append('# HELP {} {}'.format(metric, description))
+			lines.append('# TYPE {} {}'.format(metric, metricType))
+			for name, result in self.results.items():
+				value = getter(result)
+				if value is not None:
+					lines.append('{}{{check="{}"}} {}'.format(metric, self.escape(name), repr(float(value))))
+		self.page = ('\n'.join(lines) + '\n').encode()
+
+	@staticmethod
+	def escape(label):
+		return label.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+	def handlerClass(self):
+		exporter = self
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path not in ('/', '/metrics'):
+					self.send_error(404)
+					return
+				page = exporter.page
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+				self.send_header('Content-Length', str(len(page)))
+				self.end_headers()
+				self.wfile.write(page)
+
+			def log_message(self, format, *args):
+				logging.debug('Exporter: ' + format, *args)
+
+		return Handler
+
+
+class History:
+	''' Stores the numeric values detected by the checks, to be queried later with --history.
+	Every check has its own file, used as a ring buffer of fixed-size records (timestamp, value):
+	when full, the oldest records are overwritten. The files are memory-mapped, so appending a
+	record and searching a time range (binary search) never read the whole file. '''
+
+	def __init__(self, path, samples):
+		self.path = path
+		self.samples = samples
+		self.files = {}	# key-value, check name : HistoryFile
+		os.makedirs(self.path, exist_ok=True)
+
+	def append(self, section, timestamp, value):
+		try:
+			value = locale.atof(value)
+		except ValueError:
+			return	# Only numeric values are stored
+		self.getFile(section, True).append(timestamp, value)
+
+	def query(self, section, since, until):
+		''' Returns the list of tuples (timestamp, value) stored for the check between the two unix times '''
+		historyFile = self.getFile(section, False)
+		if historyFile is None:
+			return []
+		return historyFile.query(since, until)
+
+	def getFile(self, section, create):
+		if section not in self.files:
+			path = os.path.join(self.path, urllib.parse.quote(section, safe='') + '.hist')
+			if not create and not os.path.exists(path):
+				return None
+			self.files[section] = HistoryFile(path, self.samples)
+		return self.files[section]
+
+
+class HistoryFile:
+	''' A history ring buffer file: a header (magic, capacity, next record index, record count)
+	followed by capacity records of 8 bytes (unix time as uint32, value as float32) '''
+
+	MAGIC = b'HCH1'
+	HEADER = struct.Struct('<4sIII')
+	RECORD = struct.Struct('<If')
+
+	def __init__(self, path, capacity):
+		if not os.path.exists(path):
+			with open(path, 'wb') as f:
+				f.write(self.HEADER.pack(self.MAGIC, capacity, 0, 0))
+				f.truncate(self.HEADER.size + capacity * self.RECORD.size)
+
+		with open(path, 'r+b') as f:
+			self.map = mmap.mmap(f.fileno(), 0)
+		magic, self.capacity, self.head, self.count = self.HEADER.unpack_from(self.map, 0)
+		if magic != self.MAGIC or len(self.map) != self.HEADER.size + self.capacity * self.RECORD.size:
+			raise ValueError('{} is not a valid history file'.format(path))
+		if self.capacity != capacity:
+			logging.info('History file %s keeps its capacity of %d samples: delete it to apply HISTORY_SAMPLES', path, self.capacity)
+
+	def append(self, timestamp, value):
+		self.RECORD.pack_into(self.map, self.offset(self.head), int(timestamp), value)
+		self.head = (self.head + 1) % self.capacity
+		self.count = min(self.count + 1, self.capacity)
+		self.HEADER.pack_into(self.map, 0, self.MAGIC, self.capacity, self.head, self.count)
+
+	def query(self, since, until):
+		# The records are sorted by time: find the first one in range with a binary search
+		lo, hi = 0, self.count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.get(mid)[0] < since:
+				lo = mid + 1
+			else:
+				hi = mid
+
+		records = []
+		for i in range(lo, self.count):
+			record = self.get(i)
+			if record[0] > until:
+				break
+			records.append(record)
+		return records
+
+	def get(self, i):
+		''' Returns the i-th record, from the oldest one '''
+		return self.RECORD.unpack_from(self.map, self.offset((self.head - self.count + i) % self.capacity))
+
+	def offset(self, index):
+		return self.HEADER.size + index * self.RECORD.size
+
+
+class CollectorRequestHandler(http.server.BaseHTTPRequestHandler):
+	''' Collector: receives the results batches pushed by the hosts '''
+
+	def do_POST(self):
+		main = self.server.main
+		if self.path != '/push':
+			self.send_error(404)
+			return
+		if main.pushToken and not hmac.compare_digest(self.headers.get('Authorization', '').encode(), ('Bearer ' + main.pushToken).encode()):
+			self.send_error(403)
+			return
+
+		try:
+			batch = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+			count = main.collectResults(batch)
+		except (ValueError, KeyError, TypeError) as e:
+			self.send_error(400, 'Invalid batch: {}'.format(e))
+			return
+		except Exception:
+			logging.error(traceback.format_exc())
+			self.send_error(500)
+			return
+
+		response = json.dumps({ 'accepted': count }).encode()
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(response)))
+		self.end_headers()
+		self.wfile.write(response)
+
+	def log_message(self, format, *args):
+		logging.debug('Collector: ' + format, *args)
+
+
+class CollectorStore:
+	''' Collector: the last results and alarms status of all the hosts, in a sqlite database '''
+
+	def __init__(self, path):
+		os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('''CREATE TABLE IF NOT EXISTS results (
+			host TEXT NOT NULL,
+			check_name TEXT NOT NULL,
+			value TEXT,
+			error TEXT,
+			alarm_timestamp REAL,
+			updated REAL NOT NULL,
+			PRIMARY KEY (host, check_name)
+		)''')
+		self.db.execute('''CREATE TABLE IF NOT EXISTS hosts (
+			host TEXT PRIMARY KEY,
+			last_push REAL NOT NULL
+		)''')
+		self.db.commit()
+
+	def getHostStatus(self, host):
+		row = self.db.execute('SELECT last_push FROM hosts WHERE host = ?', (host,)).fetchone()
+		rows = self.db.execute('SELECT check_name, value, error, alarm_timestamp FROM results WHERE host = ?', (host,)).fetchall()
+		return HostStatus(host, row[0] if row else 0, { r[0]: list(r[1:]) for r in rows })
+
+	def save(self, hostStatus):
+		now = time.time()
+		with self.db:
+			self.db.execute('INSERT OR REPLACE INTO hosts (host, last_push) VALUES (?, ?)', (hostStatus.host, hostStatus.lastPush))
+			self.db.executemany(
+				'INSERT OR REPLACE INTO results (host, check_name, value, error, alarm_timestamp, updated) VALUES (?, ?, ?, ?, ?, ?)',
+				[ (hostStatus.host, name, r[0], r[1], r[2], now) for name, r in hostStatus.results.items() ]
+			)
+
+
+class HostStatus:
+	''' Collector: the status of a remote host, with the same interface of Status for the alarms '''
+
+	def __init__(self, host, lastPush, results):
+		self.host = host
+		self.lastPush = lastPush
+		self.results = results	# key-value, check name : [value, error, alarmTriggeredTimestamp]
+
+	def setValue(self, name, value, error):
+		result = self.results.setdefault(name, [None, None, None])
+		result[0] = value
+		result[1] = error
+
+	def setAlarm(self, almName):
+		self.results[almName][2] = time.time()
+
+	def unsetAlarm(self, almName):
+		if almName in self.results:
+			self.results[almName][2] = None
+
+	def restoreAlarm(self, almName, triggeredTimestamp):
+		if almName in self.results:
+			self.results[almName][2] = triggeredTimestamp
+
+	def getAlarmTriggeredTimestamp(self, almName):
+		return self.results.get(almName, [None, None, None])[2]
+
+
+class RateLimiter:
+	''' Token bucket: allows up to "count" events every "seconds" '''
+
+	def __init__(self, count, seconds):
+		self.capacity = count
+		self.rate = count / seconds
+		self.tokens = float(count)
+		self.updated = time.monotonic()
+
+	def allow(self):
+		now = time.monotonic()
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+		if self.tokens < 1:
+			return False
+		self.tokens -= 1
+		return True
+
+
+class Outbox:
+	''' Durable spool of the notifications still to be sent: one json file for every notification, written
+	atomically and fsync'd, so the notifications survive crashes and mail server outages.
+	A new notification replaces the pending one for the same check and event (e.g. the alarm start email
+	of a check in alarm since many runs), so the outbox doesn't fill up during long outages '''
+
+	def __init__(self, path):
+		self.path = path
+		os.makedirs(self.path, mode=0o700, exist_ok=True)
+
+	def add(self, entry):
+		# The dedup key identifies the alarm and event (the subject for emails, the alarm command is executed only on
+		# alarm start): the sub-sensors and the slow alarm of a check have their own alarm name
+		key = '\n'.join([ entry['type'], entry['host'], entry['section'], entry.get('alarm', ''), entry.get('subject', '') ])
+		entry['id'] = hashlib.sha1(key.encode()).hexdigest()
+		entry['created'] = time.time()
+		entry['attempts'] = 0
+		entry['nextAttempt'] = entry['created']
+		with self.writeLock():
+			self.write(entry)
+
+	def due(self, now):
+		''' Returns the entries to be sent now, oldest first '''
+		entries = []
+		for fileName in os.listdir(self.path):
+			if not fileName.endswith('.json'):
+				continue
+			try:
+				with open(os.path.join(self.path, fileName), 'r') as f:
+					entry = json.load(f)
+			except (OSError, ValueError) as e:
+				logging.error('Unable to read outbox entry %s: %s', fileName, e)
+				continue
+			if now - entry['created'] > OUTBOX_EXPIRE_SECONDS:
+				logging.error('Dropping %s notification for %s: unable to send it for %d days', entry['type'], entry['section'], OUTBOX_EXPIRE_SECONDS // 86400)
+				self.remove(entry)
+			elif entry['nextAttempt'] <= now:
+				entries.append(entry)
+		entries.sort(key=lambda entry: entry['created'])
+		return entries
+
+	def retryLater(self, entry):
+		entry['attempts'] += 1
+		delay = min(OUTBOX_RETRY_SECONDS * 2 ** (entry['attempts'] - 1), OUTBOX_MAX_RETRY_SECONDS)
+		entry['nextAttempt'] = time.time() + delay
+		with self.writeLock():
+			if not self.isCurrent(entry):
+				return
+			logging.info('Will retry %s notification for %s in %d seconds', entry['type'], entry['section'], delay)
+			self.write(entry)
+
+	def remove(self, entry):
+		with self.writeLock():
+			if self.isCurrent(entry):
+				os.remove(self.entryPath(entry))
+
+	def isCurrent(self, entry):
+		''' Returns False if the entry was already removed, or replaced by a newer one with the same dedup id
+		(added while it was being sent): the newer one must be neither removed nor overwritten '''
+		try:
+			with open(self.entryPath(entry), 'r') as f:
+				return json.load(f)['created'] == entry['created']
+		except (OSError, ValueError):
+			return False
+
+	def write(self, entry):
+		path = self.entryPath(entry)
+		tmpPath = path + '.tmp'
+		fd = os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+		with os.fdopen(fd, 'w') as f:
+			json.dump(entry, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmpPath, path)
+		# Make the rename durable too
+		dirFd = os.open(self.path, os.O_RDONLY)
+		try:
+			os.fsync(dirFd)
+		finally:
+			os.close(dirFd)
+
+	def entryPath(self, entry):
+		return os.path.join(self.path, entry['id'] + '.json')
+
+	@contextlib.contextmanager
+	def writeLock(self):
+		''' Context manager serializing the changes to the entries, between processes and between threads
+		(every call opens the lock file again, so flock excludes the other threads too) '''
+		with open(os.path.join(self.path, '.write.lock'), 'w') as lockFile:
+			fcntl.flock(lockFile, fcntl.LOCK_EX)
+			try:
+				yield
+			finally:
+				fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+	@contextlib.contextmanager
+	def lock(self):
+		''' Context manager preventing two processes from flushing at the same time: yields False if already locked '''
+		with open(os.path.join(self.path, '.lock'), 'w') as lockFile:
+			try:
+				fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except BlockingIOError:
+				yield False
+				return
+			try:
+				yield True
+			finally:
+				fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+
+class MailBatch:
+	''' Collects the notification emails of a run and sends them using a single connection for every SMTP server.
+	If DIGEST is enabled, the emails with the same sender and recipients are merged in a single email '''
+
+	def __init__(self, hostname):
+		self.hostname = hostname
+		self.mails = []	# list of tuples (settings, subject, body, tag)
+		self.failedTags = []	# tags of the emails that could not be sent
+
+	def add(self, s, subject, body, tag=None):
+		self.mails.append((s, subject, body, tag))
+
+	def send(self):
+		''' Sends all the collected emails. If a server fails, the emails for the other servers are sent anyway,
+		then the first error is raised '''
+		# Group the emails by SMTP server and credentials, keeping the order
+		servers = {}
+		for mail in self.mails:
+			s = mail[0]
+			key = (s.smtphost, s.smtpssl, s.smtpuser, s.smtppass)
+			servers.setdefault(key, []).append(mail)
+		self.mails = []
+
+		firstError = None
+		for mails in servers.values():
+			try:
+				self.sendToServer(mails)
+			except Exception as e:
+				logging.error('Unable to send emails via %s: %s', mails[0][0].smtphost or 'local smtp', e)
+				self.failedTags.extend(mail[3] for mail in mails)
+				if firstError is None:
+					firstError = e
+		if firstError is not None:
+			raise firstError
+
+	def sendToServer(self, mails):
+		s = mails[0][0]
+		messages = self.merge(mails)
 
-	def sendMail(self, s, subject, body):
 		if s.smtphost:
-			logging.info("Sending email to %s via %s", s.mailto, s.smtphost)
+			logging.info("Sending %d emails via %s", len(messages), s.smtphost)
+		else:
+			logging.info("Sending %d emails using local smtp", len(messages))
+
+		# Send all the messages in the same connection
+		if s.smtpssl and s.smtphost:
+			smtp = smtplib.SMTP_SSL(s.smtphost, timeout=300)
 		else:
-			logging.info("Sending email to %s using local smtp", s.mailto)
+			smtp = smtplib.SMTP(timeout=300)
+			if s.smtphost:
+				smtp.connect(s.smtphost)
+			else:
+				smtp.connect()
+		try:
+			if s.smtpuser or s.smtppass:
+				smtp.login(s.smtpuser, s.smtppass)
+			for m_from, mailto, subject, body in messages:
+				logging.info("Sending email to %s", mailto)
+				smtp.sendmail(m_from, mailto, self.buildMessage(m_from, mailto, subject, body).as_string())
+		finally:
+			smtp.quit()
+
+	def merge(self, mails):
+		''' Returns the list of messages to send as tuples (from, to, subject, body), merging in a digest
+		the ones from checks with DIGEST enabled sent from and to the same addresses '''
+		messages = []	# list of tuples (from, to, subjects, bodies)
+		digests = {}	# key-value, (from, to) : digest message
+		for s, subject, body, tag in mails:
+			if s.mailfrom:
+				m_from = s.mailfrom
+			else:
+				m_from = s.username + "@" + s.hostname
+
+			key = (m_from, tuple(s.mailto)) if s.digest else None
+			if key is not None and key in digests:
+				digests[key][2].append(subject)
+				digests[key][3].append(body)
+				continue
 
+			message = (m_from, s.mailto, [subject], [body])
+			messages.append(message)
+			if key is not None:
+				digests[key] = message
+
+		# Build the digests subject and body
+		result = []
+		for m_from, mailto, subjects, bodies in messages:
+			if len(subjects) == 1:
+				result.append((m_from, mailto, subjects[0], bodies[0]))
+			else:
+				result.append((
+					m_from,
+					mailto,
+					EMAIL_DIGEST_SUBJECT_TPL.format(self.hostname, len(subjects)),
+					'\n\n'.join('{}\n{}'.format(sub, body) for sub, body in zip(subjects, bodies))
+				))
+		return result
+
+	def buildMessage(self, m_from, mailto, subject, body):
 		# Create main message
 		msg = MIMEMultipart()
 		msg['Subject'] = subject
-		if s.mailfrom:
-			m_from = s.mailfrom
-		else:
-			m_from = s.username + "@" + s.hostname
 		msg['From'] = m_from
-		msg['To'] = ', '.join(s.mailto)
+		msg['To'] = ', '.join(mailto)
 		msg.preamble = 'This is a multi-part message in MIME format.'
 
 		# Add base text
 		txt = MIMEText(body)
 		msg.attach(txt)
+		return msg
+
+
+class LogFile:
+	''' Reads only the lines appended to a log file since the previous run, so the cost of a run depends on the
+	amount of new lines, not on the log size. The position reached is identified by the file path, inode
+	(to detect rotation) and offset (to detect truncation) '''
+
+	CHUNK_SIZE = 1024 * 1024
+
+	@classmethod
+	def countMatches(cls, path, regexp, position):
+		''' Counts the new lines matching the regexp. The position is the one returned by the previous call,
+		or None: in that case the existing lines are skipped. Returns a tuple (count, new position) '''
+		with open(path, 'rb') as f:
+			st = os.fstat(f.fileno())
+			if position is None or position[0] != path:
+				# Never read: only the lines written from now on are counted
+				return 0, (path, st.st_ino, st.st_size)
+
+			offset = position[2]
+			if position[1] != st.st_ino or st.st_size < offset:
+				# Rotated or truncated: the new file is read from the beginning
+				offset = 0
+
+			f.seek(offset)
+			count = 0
+			partial = b''
+			while True:
+				chunk = f.read(cls.CHUNK_SIZE)
+				if not chunk:
+					break
+				# Only complete lines are read: a line still being written is read in the next run
+				data = partial + chunk
+				end = data.rfind(b'\n') + 1
+				partial = data[end:]
+				offset += end
+				count += sum(1 for line in data[:end].decode(errors='replace').splitlines() if regexp.search(line))
+
+			return count, (path, st.st_ino, offset)
+
+
+class Collectors:
+	''' Built-in collectors, reading the most common values directly from the kernel
+	(without running any command). Every collector returns the value as a string,
+	formatted like the commands output would be (numbers using the locale decimal separator) '''
+
+	LOADAVG_FILE = '/proc/loadavg'
+	MEMINFO_FILE = '/proc/meminfo'
+	MDSTAT_FILE = '/proc/mdstat'
+	HWMON_DIR = '/sys/class/hwmon'
+
+	@classmethod
+	def collect(cls, name, arg):
+		collectors = {
+			'load1': lambda arg: cls.load(0),
+			'load5': lambda arg: cls.load(1),
+			'load15': lambda arg: cls.load(2),
+			'available_ram': lambda arg: cls.availableRam(),
+			'used_disk_space': lambda arg: cls.usedDiskSpace(arg or '/'),
+			'raid_status': lambda arg: cls.raidStatus(arg),
+			'temperature': lambda arg: cls.hwmon('temp', arg),
+			'fan_speed': lambda arg: cls.hwmon('fan', arg),
+		}
+		if name not in collectors:
+			raise ValueError('unknown collector "{}": expected one of {}'.format(name, ', '.join(collectors)))
+		return collectors[name](arg)
+
+	@classmethod
+	def load(cls, index):
+		''' System load average over 1, 5 or 15 minutes, from /proc/loadavg '''
+		with open(cls.LOADAVG_FILE, 'r') as f:
+			return locale.str(float(f.read().split()[index]))
+
+	@classmethod
+	def availableRam(cls):
+		''' Available ram in percent, from /proc/meminfo (same as "available" column of `free`) '''
+		meminfo = {}
+		with open(cls.MEMINFO_FILE, 'r') as f:
+			for line in f:
+				key, _, value = line.partition(':')
+				meminfo[key] = int(value.split()[0])
+		return str(int(meminfo['MemAvailable'] / meminfo['MemTotal'] * 100.0))
+
+	@staticmethod
+	def usedDiskSpace(path):
+		''' Used disk space in percent of the filesystem containing path (same as `df`) '''
+		st = os.statvfs(path)
+		used = (st.f_blocks - st.f_bfree) * st.f_frsize
+		available = st.f_bavail * st.f_frsize
+		if used + available == 0:
+			return '0'
+		# df rounds up
+		return str(-(-used * 100 // (used + available)))
+
+	@classmethod
+	def raidStatus(cls, array):
+		''' Status of the disks of a raid array (e.g. "UU", or "U_" if a disk failed), from /proc/mdstat.
+		If array (e.g. "md0") is not provided, the first array is used '''
+		with open(cls.MDSTAT_FILE, 'r') as f:
+			lines = f.read().splitlines()
+
+		inArray = False
+		for line in lines:
+			if not line.startswith((' ', '\t')):
+				name = line.split(' : ')[0].strip()
+				inArray = name.startswith('md') and (not array or name == array)
+				continue
+			if inArray:
+				# Looking for the disks status (e.g. "243553280 blocks super 1.2 [2/2] [UU]")
+				for token in reversed(line.split()):
+					if len(token) > 2 and token[0] == '[' and token[-1] == ']' and set(token[1:-1]) <= set('U_'):
+						return token[1:-1]
+		raise ValueError('raid array {} not found'.format(array) if array else 'no raid arrays found')
+
+	@classmethod
+	def hwmon(cls, kind, label):
+		''' Reads a temperature (in °C) or fan speed (in RPM) sensor from /sys/class/hwmon.
+		The label is the one shown by `sensors` (e.g. "Core 0" or "cpu_fan"). If more chips
+		have a sensor with the same label, it can be prefixed by the chip name (e.g. "coretemp/Core 0") '''
+		if not label:
+			raise ValueError('COLLECTOR_ARG is mandatory: the sensor label (as shown by `sensors`)')
+		chip, _, label = label.rpartition('/')
+
+		for hwmonDir in sorted(os.listdir(cls.HWMON_DIR)):
+			path = os.path.join(cls.HWMON_DIR, hwmonDir)
+			if chip and cls.readSysFile(os.path.join(path, 'name')) != chip:
+				continue
+			for fileName in sorted(os.listdir(path)):
+				if not fileName.startswith(kind) or not fileName.endswith('_input'):
+					continue
+				sensor = fileName[:-len('_input')]
+				# Sensors without label are named after the file (e.g. "temp1")
+				sensorLabel = cls.readSysFile(os.path.join(path, sensor + '_label')) or sensor
+				if sensorLabel != label:
+					continue
+				value = int(cls.readSysFile(os.path.join(path, fileName)))
+				if kind == 'temp':
+					# Millidegrees
+					return locale.str(value / 1000)
+				return str(value)
+		raise ValueError('sensor {} not found'.format(label))
+
+	@staticmethod
+	def readSysFile(path):
+		try:
+			with open(path, 'r') as f:
+				return f.read().strip()
+		except FileNotFoundError:
+			return None
+
+
+class CommandOutput(subprocess.CompletedProcess):
+	''' The output of a check command. If the command was stopped before its end, stopReason is "matched"
+	(all the regexps of the checks using it matched) or "truncated" (its output exceeded MAX_OUTPUT_BYTES) '''
+
+	def __init__(self, args, returncode, stdout, stderr, stopReason=None):
+		super().__init__(args, returncode, stdout, stderr)
+		self.stopReason = stopReason
+
+
+class CommandCache:
+	''' Runs the check commands, executing every distinct command only once per run.
+	Thread safe: if a command is already running, the other callers wait for its output.
+	The output is read in chunks, so the command can be stopped as soon as it is not needed anymore:
+	when its output exceeds MAX_OUTPUT_BYTES or, if all the checks using it have STOP_ON_MATCH, when
+	all their regexps matched '''
+
+	def __init__(self, checks):
+		self.results = {}	# key-value, command key (see key()) : Future of CommandOutput
+		self._lock = threading.Lock()
+		self.consumers = {}	# key-value, command key : settings of the checks of this run using the command
+		for s in checks:
+			if s.command and not s.logfile and not s.collector:
+				self.consumers.setdefault(self.key(s), []).append(s)
+
+	def run(self, config):
+		''' Runs the command of the check and returns its CommandOutput, or the cached one if the same command was
+		already executed. Raises subprocess.TimeoutExpired if the command doesn't complete within TIMEOUT seconds '''
+		key = self.key(config)
+		with self._lock:
+			future = self.results.get(key)
+			isOwner = future is None
+			if isOwner:
+				future = concurrent.futures.Future()
+				self.results[key] = future
+
+		if not isOwner:
+			logging.debug('Reusing output of already executed command %s', key[0])
+			return future.result()
 
-		# Send the message
-		if s.smtpssl and s.smtphost:
-			smtp = smtplib.SMTP_SSL(s.smtphost, timeout=300)
-		else:
-			smtp = smtplib.SMTP(timeout=300)
-
-		if s.smtphost:
-			smtp.connect(s.smtphost)
+		try:
+			future.set_result(self.execute(key[0], config, self.consumers.get(key, [config])))
+		except Exception as e:
+			future.set_exception(e)
+		return future.result()
+
+	def execute(self, command, config, consumers):
+		''' Runs the command with the TIMEOUT and limits of config, reading its output until it is needed by consumers '''
+		if any(s.max_output_bytes == 0 for s in consumers):
+			maxBytes = None
 		else:
-			smtp.connect()
-		if s.smtpuser or s.smtppass:
-			smtp.login(s.smtpuser, s.smtppass)
-		smtp.sendmail(m_from, s.mailto, msg.as_string())
-		smtp.quit()
-
-	def executeAlarmCommand(self, s, error):
-		cmdToRun = s.alarmCommand
-		cmdToRun = cmdToRun.replace('%%CHECKNAME%%', s.name)
-		cmdToRun = cmdToRun.replace('%%HOSTNAME%%', self.hostname)
-		cmdToRun = cmdToRun.replace('%%DATETIME%%', time.strftime("%a, %d %b %Y %H:%M:%S"))
-		cmdToRun = cmdToRun.replace('%%ERROR%%', error)
-
-		logging.debug("Executing alarm command %s", cmdToRun)
+			maxBytes = max(s.max_output_bytes for s in consumers)
+		pendingRegexps = None
+		if all(s.stop_on_match and not s.match_all for s in consumers):
+			pendingRegexps = [ s.regexp for s in consumers ]
+
+		# The command runs in its own process group, to be able to kill the whole
+		# shell pipeline on timeout
+		proc = subprocess.Popen(self.getArgs(command, config), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+			start_new_session=True)
+
+		deadline = None if config.timeout is None else time.monotonic() + config.timeout
+		stdout = bytearray()
+		stderr = bytearray()
+		searched = 0	# stdout bytes already searched with the pending regexps (complete lines only)
+		stopReason = None
+		with proc, selectors.DefaultSelector() as selector:
+			selector.register(proc.stdout, selectors.EVENT_READ, stdout)
+			selector.register(proc.stderr, selectors.EVENT_READ, stderr)
+			while selector.get_map():
+				remaining = None if deadline is None else deadline - time.monotonic()
+				if remaining is not None and remaining <= 0:
+					self.killOnTimeout(proc, command, config.timeout)
+				for key, events in selector.select(remaining):
+					chunk = os.read(key.fd, OUTPUT_CHUNK_BYTES)
+					if chunk:
+						key.data.extend(chunk)
+					else:
+						selector.unregister(key.fileobj)
+
+				if maxBytes is not None and (len(stdout) > maxBytes or len(stderr) > maxBytes):
+					stopReason = 'truncated'
+					del stdout[maxBytes:]
+					del stderr[maxBytes:]
+					# The last line may be incomplete
+					lastLine = stdout.rfind(b'\n') + 1
+					if lastLine > 0:
+						del stdout[lastLine:]
+					break
+				if pendingRegexps:
+					# Only the complete lines are searched: a value may be split between two chunks
+					lastLine = stdout.rfind(b'\n') + 1
+					if lastLine > searched:
+						text = stdout[searched:lastLine].decode(errors='replace')
+						pendingRegexps = [ regexp for regexp in pendingRegexps if not regexp.search(text) ]
+						searched = lastLine
+						if not pendingRegexps:
+							stopReason = 'matched'
+							del stdout[lastLine:]
+							break
+
+			if stopReason:
+				logging.debug('Command %s output not needed anymore (%s): stopping it', command, stopReason)
+				self.kill(proc)
+				return CommandOutput(command, None, bytes(stdout), bytes(stderr), stopReason)
+			# The command may keep running after closing its output
+			try:
+				proc.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+			except subprocess.TimeoutExpired:
+				self.killOnTimeout(proc, command, config.timeout)
+		return CommandOutput(command, proc.returncode, bytes(stdout), bytes(stderr))
+
+	def killOnTimeout(self, proc, command, timeout):
+		logging.warning('Command %s did not complete within %s seconds: killing it', command, timeout)
+		self.kill(proc)
+		raise subprocess.TimeoutExpired(command, timeout)
+
+	@staticmethod
+	def kill(proc):
+		try:
+			os.killpg(proc.pid, signal.SIGKILL)
+		except ProcessLookupError:
+			pass
+		proc.wait()
+
+	@staticmethod
+	def getArgs(command, config):
+		''' Returns the arguments running the command in a shell, with NICE, IONICE, MAX_MEMORY_MB and MAX_CPU_SECONDS.
+		The limits are applied by the wrapping commands and by the shell (a preexec_fn may deadlock the child
+		process, as the checks run in more threads) '''
+		script = ''
+		if config.max_memory_mb is not None:
+			script += 'ulimit -v {} || exit 126\n'.format(config.max_memory_mb * 1024)
+		if config.max_cpu_seconds is not None:
+			script += 'ulimit -t {} || exit 126\n'.format(config.max_cpu_seconds)
+		args = [ '/bin/sh', '-c', script + command ]
+		if config.ionice:
+			args = [ 'ionice' ] + IONICE_ARGS[config.ionice] + args
+		if config.nice is not None:
+			args = [ 'nice', '-n', str(config.nice) ] + args
+		return args
+
+	@classmethod
+	def key(cls, s):
+		# The output is shared only by the checks running the command with the same limits
+		return (cls.normalize(s.command), s.timeout, s.nice, s.ionice, s.max_memory_mb, s.max_cpu_seconds)
+
+	@staticmethod
+	def normalize(command):
+		# Only the surrounding whitespace is stripped: collapsing the inner one would change
+		# the meaning of quoted arguments
+		return command.strip()
+
+
+class RunLock:
+	''' Prevents overlapping runs (e.g. cron starting a run while the previous one is stuck on a slow command),
+	that would execute the same commands and overwrite each other's status. While a run is in progress, a single
+	following run waits for it to end and the others are skipped: so at most two processes are alive '''
+
+	def __init__(self, path):
+		self.path = path
+		self.lockFile = None
+
+	def acquire(self, wait, daemon=False):
+		''' Returns True if the lock has been acquired. If already locked and wait is True, waits for
+		the lock to be released, unless another process is already waiting for it or the lock is held by
+		a daemon (that never releases it) '''
+		lockFile = open(self.path + '.lock', 'a')
+		try:
+			fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			if not wait or not self.waitTurn(lockFile):
+				lockFile.close()
+				return False
+		# Tells the waiting processes who is holding the lock
+		lockFile.truncate(0)
+		lockFile.write('{} {}\n'.format('daemon' if daemon else 'run', os.getpid()))
+		lockFile.flush()
+		self.lockFile = lockFile
+		return True
+
+	def waitTurn(self, lockFile):
+		''' Waits for the lock, if no other process is waiting for it. Returns False otherwise '''
+		with open(self.path + '.queue', 'a') as queueFile:
+			try:
+				fcntl.flock(queueFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except BlockingIOError:
+				logging.info('Another run is already waiting for the previous one to end')
+				# The waiting run will get the changes happened meanwhile: no need for another one
+				return False
+			logging.info('The previous run is still running, waiting for it to end')
+			# Polling, to notice a daemon started meanwhile
+			while True:
+				if self.heldByDaemon():
+					logging.info('The lock is held by a daemon, that runs until stopped')
+					return False
+				try:
+					fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+					return True
+				except BlockingIOError:
+					time.sleep(RUN_LOCK_POLL_SECONDS)
+
+	def heldByDaemon(self):
+		try:
+			with open(self.path + '.lock', 'r') as f:
+				return f.read().startswith('daemon')
+		except OSError:
+			return False
 
-		ret = subprocess.run(cmdToRun, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-		if ret.stderr:
-			self._log.info('{} subprocess stderr:\n{}', cmdToRun, ret.stderr.decode())
-		if ret.stdout:
-			stdout = ret.stdout.decode()
-			self._log.debug('{} subprocess stdout:\n{}', cmdToRun, stdout)
-		if ret.returncode != 0:
-			self._log.error('subprocess {} exited with error code {}'.format(cmdToRun, ret.returncode))
+	def release(self):
+		''' Closing the file releases the lock '''
+		if self.lockFile:
+			self.lockFile.truncate(0)
+			self.lockFile.close()
+			self.lockFile = None
 
 
 class Status:
@@ -263,17 +1826,33 @@ class Status:
 		try:
 			with open(STATUS_FILE, 'r') as openfile:
 				self.status = json.load(openfile)
-		except FileNotFoundError:
+		except (FileNotFoundError, ValueError) as e:
+			if isinstance(e, ValueError):
+				# Half written by a version not writing it atomically
+				logging.error('Ignoring corrupted status file {}: {}'.format(STATUS_FILE, e))
 			self.status =  {
 				'lastRun': 0,	# unix time in seconds
 				'alarms': {},	# key-value, alarmName : alarmTriggeredTimestamp
 			}
+		self.status.setdefault('windows', {})	# key-value, checkName : last values (for ALARM_AGGREGATE)
+		self.status.setdefault('timings', {})	# key-value, checkName : timings of the last run and average duration
+		self.status.setdefault('logfiles', {})	# key-value, checkName : [path, inode, offset] of the LOGFILE already read
+		self.status.setdefault('display', {})	# text shown on the LCD_URL display, time it was sent and next page
+		self.status.setdefault('schedule', {})	# key-value, checkName : last run time and interval before the next one
+		self.windows = {}	# key-value, checkName : RollingWindow
 
 	def save(self):
 		self.status['lastRun'] = time.time()
+		for name, window in self.windows.items():
+			self.status['windows'][name] = window.values()
 		jo = json.dumps(self.status)
-		with open(STATUS_FILE, "w") as outfile:
+		# Written to a temporary file and renamed, so the status file is never found half written
+		tmpPath = STATUS_FILE + '.new'
+		with open(tmpPath, "w") as outfile:
 			outfile.write(jo)
+			outfile.flush()
+			os.fsync(outfile.fileno())
+		os.replace(tmpPath, STATUS_FILE)
 
 	def setAlarm(self, almName):
 		self.status['alarms'][almName] = time.time()
@@ -281,24 +1860,248 @@ class Status:
 	def unsetAlarm(self, almName):
 		self.status['alarms'].pop(almName, None)
 
+	def restoreAlarm(self, almName, triggeredTimestamp):
+		if triggeredTimestamp is None:
+			self.unsetAlarm(almName)
+		else:
+			self.status['alarms'][almName] = triggeredTimestamp
+
+	def getAlarms(self):
+		''' Returns the triggered alarms: key-value, alarmName : alarmTriggeredTimestamp '''
+		return self.status['alarms']
+
+	def getDisplayState(self):
+		return self.status['display']
+
 	def getAlarmTriggeredTimestamp(self, almName):
 		return self.status['alarms'].get(almName, None)
 
+	def getWindow(self, name, size):
+		''' Returns the RollingWindow with the last values of a check, restoring it from the saved status if needed '''
+		window = self.windows.get(name)
+		if window is None or window.size != size:
+			window = RollingWindow(size)
+			for value in self.status['windows'].get(name, [])[-size:]:
+				window.push(value)
+			self.windows[name] = window
+		return window
+
+	def updateTiming(self, name, result, timestamp):
+		''' Stores the timings of the last run of a check and returns its updated average duration '''
+		previous = self.status['timings'].get(name)
+		if previous is None:
+			avgDuration = result.duration
+		else:
+			avgDuration = TIMING_EWMA_ALPHA * result.duration + (1 - TIMING_EWMA_ALPHA) * previous['avgDuration']
+		self.status['timings'][name] = {
+			'timestamp': timestamp,
+			'duration': result.duration,
+			'avgDuration': avgDuration,
+			'exitCode': result.exitCode,
+			'outputBytes': result.outputBytes,
+			'regexpTime': result.regexpTime,
+		}
+		return avgDuration
+
+	def updateSchedule(self, s, timestamp, inAlarm):
+		''' Stores the run of a check and computes the interval before the next one: a check in alarm runs every
+		ALARM_INTERVAL, an healthy one every INTERVAL or, with MAX_INTERVAL, every twice the previous interval
+		(up to MAX_INTERVAL). A random delay up to INTERVAL_JITTER is added, to spread the heavy checks '''
+		previous = self.status['schedule'].get(s.name)
+		if inAlarm:
+			interval = s.alarm_interval or s.interval
+		elif s.max_interval and previous and not previous['inAlarm']:
+			interval = min(max(previous['interval'] * 2, s.interval), s.max_interval)
+		else:
+			interval = s.interval
+		self.status['schedule'][s.name] = {
+			'lastRun': timestamp,
+			'interval': interval,
+			'jitter': random.uniform(0, s.interval_jitter),
+			'inAlarm': inAlarm,
+		}
+
+	def getInterval(self, s):
+		''' Returns the seconds between the previous run of a check and the next one '''
+		entry = self.status['schedule'].get(s.name)
+		if entry is None:
+			return s.interval
+		# Limited to the configured intervals, in case they have been reduced after the previous run
+		interval = min(entry['interval'], max(s.max_interval or s.interval, s.alarm_interval or 0))
+		return interval + min(entry['jitter'], s.interval_jitter)
+
+	def getNextRun(self, s):
+		''' Returns the time the check is due (0 if never run) '''
+		entry = self.status['schedule'].get(s.name)
+		if entry is None:
+			return 0
+		return entry['lastRun'] + self.getInterval(s)
+
+	def getTimings(self):
+		return self.status['timings']
+
+	def getLogPosition(self, name):
+		position = self.status['logfiles'].get(name)
+		return tuple(position) if position else None
+
+	def setLogPosition(self, name, position):
+		self.status['logfiles'][name] = list(position)
+
+	def getAlarmNames(self, checkName):
+		''' Returns the names of the alarms of a check: its own, the ones of its sub-sensors and the slow check one '''
+		return [ almName for almName in self.status['alarms'] if self.getCheckName(almName) == checkName ]
+
+	@staticmethod
+	def getCheckName(almName):
+		''' Returns the name of the check an alarm belongs to, e.g. "load" for "load[load5]" or "load (slow)" '''
+		if almName.endswith(SLOW_ALARM_SUFFIX):
+			return almName[:-len(SLOW_ALARM_SUFFIX)]
+		if almName.endswith(']') and '[' in almName:
+			return almName[:almName.rindex('[')]
+		return almName
+
+	def retainAlarms(self, checks):
+		''' Forgets the alarms, the timings and the log positions of checks not present anymore in the config '''
+		names = set(s.name for s in checks)
+		for almName in list(self.status['alarms']):
+			if almName not in names and self.getCheckName(almName) not in names:
+				self.unsetAlarm(almName)
+		for key in ('timings', 'logfiles'):
+			for name in list(self.status[key]):
+				if name not in names:
+					del self.status[key][name]
+
+
+class RollingWindow:
+	''' The last N values detected by a check, with their aggregates (avg, min, max, percentiles) kept up to date
+	at every new value, without rescanning all of them: running sum for the average, monotonic queues for
+	min and max, sorted list for percentiles '''
+
+	def __init__(self, size):
+		self.size = size
+		self.window = collections.deque()	# the values, oldest first
+		self.sum = 0.0
+		self.pushed = 0	# number of values pushed since creation, used as sequence number
+		self.maxQueue = collections.deque()	# tuples (seq, value) with decreasing values: the first is the max
+		self.minQueue = collections.deque()	# tuples (seq, value) with increasing values: the first is the min
+		self.sorted = []
+
+	def push(self, value):
+		if len(self.window) == self.size:
+			oldest = self.window.popleft()
+			self.sum -= oldest
+			del self.sorted[bisect.bisect_left(self.sorted, oldest)]
+		self.window.append(value)
+		self.sum += value
+		bisect.insort(self.sorted, value)
+		if self.pushed % (self.size * 100) == 0:
+			# Recompute the sum from time to time, to avoid float errors accumulation
+			self.sum = math.fsum(self.window)
+
+		seq = self.pushed
+		self.pushed += 1
+		for queue, isWorse in ((self.maxQueue, lambda v: v <= value), (self.minQueue, lambda v: v >= value)):
+			while queue and isWorse(queue[-1][1]):
+				queue.pop()
+			queue.append((seq, value))
+			# Drop the values out of the window
+			while queue[0][0] <= seq - self.size:
+				queue.popleft()
+
+	def aggregate(self, kind):
+		if kind == 'avg':
+			return self.sum / len(self.window)
+		if kind == 'max':
+			return self.maxQueue[0][1]
+		if kind == 'min':
+			return self.minQueue[0][1]
+		# Percentile (e.g. p95), nearest-rank method
+		percentile = int(kind[1:])
+		return self.sorted[max(math.ceil(percentile / 100 * len(self.sorted)) - 1, 0)]
+
+	def values(self):
+		return list(self.window)
+
+	def __len__(self):
+		return len(self.window)
+
+
+class Scheduler:
+	''' Decides when every check must run, based on its interval (see Status.updateSchedule). The checks are kept
+	in a heap ordered by next run time '''
+
+	def __init__(self, checks, status):
+		# Every check is due when scheduled by its previous run (at startup and on reload too), immediately if never run.
+		# The sequence number keeps the config order for checks due at the same time.
+		self.heap = [ (status.getNextRun(s), seq, s) for seq, s in enumerate(checks) ]
+		heapq.heapify(self.heap)
+		self.order = { s.name: seq for seq, s in enumerate(checks) }
+
+	def popDue(self, now):
+		''' Removes and returns the checks due at the given time, in config order '''
+		due = []
+		while self.heap and self.heap[0][0] <= now:
+			due.append(heapq.heappop(self.heap))
+		due.sort(key=lambda entry: entry[1])
+		self.lastDue = { entry[2].name: entry[0] for entry in due }
+		return [ entry[2] for entry in due ]
+
+	def reschedule(self, checks, now, status):
+		for s in checks:
+			interval = status.getInterval(s)
+			nextRun = self.lastDue[s.name] + interval
+			if nextRun <= now:
+				# Running late (the checks took longer than the interval): do not try to catch up
+				nextRun = now + interval
+			heapq.heappush(self.heap, (nextRun, self.order[s.name], s))
+
+	def nextDue(self):
+		if not self.heap:
+			return float('inf')
+		return self.heap[0][0]
+
+
+class HostIdentity:
+	''' Names of the host and of the user running the checks, resolved only once (getfqdn may need a slow DNS lookup) '''
+
+	__slots__ = ('nodename', 'fqdn', 'hostname', 'username')
+
+	def __init__(self):
+		self.nodename = os.uname()[1]
+		self.fqdn = socket.getfqdn()
+		self.hostname = socket.gethostname()
+		self.username = getpass.getuser()
+
 
 class Settings:
-	''' Represents settings for a check '''
+	''' Represents settings for a check, compiled once when the config is loaded:
+	the regexp is precompiled, the thresholds are parsed and the comparator is built '''
 
 	EMAIL_LIST_SEP = ','
 
-	def __init__(self, name, config):
+	__slots__ = (
+		'config', 'hostname', 'username', 'name', 'disabled',
+		'smtphost', 'smtpuser', 'smtppass', 'smtpssl', 'mailto', 'digest', 'alarmCommand', 'mailfrom',
+		'alarm_string_equal', 'alarm_string_not_equal', 'alarm_value_equal', 'alarm_value_not_equal',
+		'alarm_value_more_than', 'alarm_value_less_than',
+		'notify', 'notify_minutes', 'notify_alarm_end', 'aggregate', 'window',
+		'interval', 'interval_jitter', 'alarm_interval', 'max_interval', 'timeout', 'slow_threshold',
+		'max_output_bytes', 'stop_on_match', 'nice', 'ionice', 'max_memory_mb', 'max_cpu_seconds',
+		'command', 'collector', 'collector_arg', 'logfile', 'regexp', 'match_all', 'compare', 'subComparators',
+	)
+
+	def __init__(self, name, config, identity):
 		self.config = config
-		self.hostname = socket.getfqdn()
-		self.username = getpass.getuser()
+		self.hostname = identity.fqdn
+		self.username = identity.username
 
 		## Check name
 		self.name = name
 		## Disabled
 		self.disabled = self.getBoolean(name, 'DISABLED', False)
+		if self.disabled:
+			# Not compiled: a mistake in a disabled check must not prevent the others from running
+			return
 		## Email server connection data
 		self.smtphost = self.getStr(name, 'SMTPHOST', None)
 		self.smtpuser = self.getStr(name, 'SMTPUSER', None)
@@ -310,25 +2113,147 @@ class Settings:
 			self.mailto = [ x.strip() for x in mailtoList.strip().split(self.EMAIL_LIST_SEP) ]
 		else:
 			self.mailto = None
+		## Merge the notifications of the same run in a single email
+		self.digest = self.getBoolean(name, 'DIGEST', False)
 		## Command to execute in case of alarms (disabled if missing)
 		self.alarmCommand = self.getStr(name, 'ALARM_COMMAND', None)
 		## Sender address for the notification email
-		self.mailfrom = self.getStr(name, 'MAILFROM', getpass.getuser()+'@'+socket.gethostname())
+		self.mailfrom = self.getStr(name, 'MAILFROM', identity.username+'@'+identity.hostname)
 		## Values to compare
 		self.alarm_string_equal = self.getStr(name, 'ALARM_STRING_EQUAL', None)
 		self.alarm_string_not_equal = self.getStr(name, 'ALARM_STRING_NOT_EQUAL', None)
-		self.alarm_value_equal = self.getStr(name, 'ALARM_VALUE_EQUAL', None)
-		self.alarm_value_not_equal = self.getStr(name, 'ALARM_VALUE_NOT_EQUAL', None)
-		self.alarm_value_more_than = self.getStr(name, 'ALARM_VALUE_MORE_THAN', None)
-		self.alarm_value_less_than = self.getStr(name, 'ALARM_VALUE_LESS_THAN', None)
+		self.alarm_value_equal = self.getFloat(name, 'ALARM_VALUE_EQUAL', None)
+		self.alarm_value_not_equal = self.getFloat(name, 'ALARM_VALUE_NOT_EQUAL', None)
+		self.alarm_value_more_than = self.getFloat(name, 'ALARM_VALUE_MORE_THAN', None)
+		self.alarm_value_less_than = self.getFloat(name, 'ALARM_VALUE_LESS_THAN', None)
 		## Notification policy
 		self.notify = self.getEnum(name, 'NOTIFY', 'EVERY_RUN', ['EVERY_RUN', 'START', 'ONCE_IN_MINUTES'])
 		self.notify_minutes = self.getInt(name, 'NOTIFY_MINUTES', 0)
 		self.notify_alarm_end = self.getBoolean(name, 'NOTIFY_ALARM_END', True)
+		## Compare the aggregate of the last WINDOW values, instead of the detected value
+		self.aggregate = self.getStr(name, 'ALARM_AGGREGATE', None)
+		if self.aggregate and self.aggregate not in ('avg', 'min', 'max') and not re.fullmatch(r'p(100|[1-9]\d?)', self.aggregate):
+			raise ValueError("Invalid value {} for configuration ALARM_AGGREGATE: expected one of avg, min, max, p1...p100".format(self.aggregate))
+		self.window = self.getInt(name, 'WINDOW', 5)
+		if self.window <= 0:
+			raise ValueError("Invalid value {} for configuration WINDOW: expected a positive number of values".format(self.window))
+		## Seconds between two executions of the check
+		self.interval = self.getInt(name, 'INTERVAL', 60)
+		if self.interval <= 0:
+			raise ValueError("Invalid value {} for configuration INTERVAL: expected a positive number of seconds".format(self.interval))
+		## Max random seconds added to the interval
+		self.interval_jitter = self.getInt(name, 'INTERVAL_JITTER', 0)
+		if self.interval_jitter < 0:
+			raise ValueError("Invalid value {} for configuration INTERVAL_JITTER: expected a number of seconds".format(self.interval_jitter))
+		## Seconds between two executions of the check while in alarm (default INTERVAL)
+		self.alarm_interval = self.getInt(name, 'ALARM_INTERVAL', None)
+		if self.alarm_interval is not None and self.alarm_interval <= 0:
+			raise ValueError("Invalid value {} for configuration ALARM_INTERVAL: expected a positive number of seconds".format(self.alarm_interval))
+		## Max seconds between two executions of an healthy check, doubling the interval at every run (disabled if missing)
+		self.max_interval = self.getInt(name, 'MAX_INTERVAL', None)
+		if self.max_interval is not None and self.max_interval < self.interval:
+			raise ValueError("Invalid value {} for configuration MAX_INTERVAL: expected at least INTERVAL seconds".format(self.max_interval))
+		## Max seconds the command may run before being killed (no limit if missing)
+		self.timeout = self.getInt(name, 'TIMEOUT', None)
+		## Raise an alarm if the check takes on average more than these seconds (disabled if missing)
+		self.slow_threshold = self.getFloat(name, 'SLOW_THRESHOLD', None)
+		## Max bytes of command output to read: then the command is stopped (0 for no limit)
+		self.max_output_bytes = self.getInt(name, 'MAX_OUTPUT_BYTES', OUTPUT_DEFAULT_MAX_BYTES)
+		if self.max_output_bytes < 0:
+			raise ValueError("Invalid value {} for configuration MAX_OUTPUT_BYTES: expected a number of bytes".format(self.max_output_bytes))
+		## Stop the command as soon as the regexp matched a line, without reading the rest of the output
+		self.stop_on_match = self.getBoolean(name, 'STOP_ON_MATCH', False)
+		## Niceness added to the command (not changed if missing)
+		self.nice = self.getInt(name, 'NICE', None)
+		## IO scheduling class of the command: idle or best-effort (not changed if missing)
+		self.ionice = self.getStr(name, 'IONICE', None)
+		if self.ionice is not None and self.ionice not in IONICE_ARGS:
+			raise ValueError("Invalid value {} for configuration IONICE: expected one of {}".format(self.ionice, ', '.join(IONICE_ARGS)))
+		## Max memory (address space) and cpu time of the command process (no limit if missing)
+		self.max_memory_mb = self.getInt(name, 'MAX_MEMORY_MB', None)
+		self.max_cpu_seconds = self.getInt(name, 'MAX_CPU_SECONDS', None)
 		## Command to obtain the value for comparation
 		self.command = self.getStr(name, 'COMMAND', None)
+		## Built-in collector to obtain the value without running a command (overrides COMMAND and REGEXP)
+		self.collector = self.getStr(name, 'COLLECTOR', None)
+		## Collector parameter (e.g. the path for used_disk_space or the sensor label for temperature)
+		self.collector_arg = self.getStr(name, 'COLLECTOR_ARG', None)
+		## Log file to watch: the detected value is the number of new lines matching REGEXP (overrides COMMAND and COLLECTOR)
+		self.logfile = self.getStr(name, 'LOGFILE', None)
 		## Regexp to extract value from command output (default to match full string)
-		self.regexp = self.getStr(name, 'REGEXP', '(.*)')
+		self.regexp = self.getRegexp(name, 'REGEXP', '(.*)')
+		## Every match of the regexp is a sub-sensor, named after its "name" group, with the value in its "value" group
+		self.match_all = self.getBoolean(name, 'MATCH_ALL', False)
+		if self.match_all and 'value' not in self.regexp.groupindex:
+			raise ValueError("Invalid regexp {} for configuration REGEXP: MATCH_ALL needs a (?P<value>...) group".format(self.regexp.pattern))
+		## Function comparing the detected value with the configured values
+		self.compare = self.buildComparator()
+		## Comparators of the sub-sensors (named groups, or MATCH_ALL matches)
+		self.subComparators = {}
+
+	def buildComparator(self, sub=None):
+		''' Returns a function checking a detected value against the configured values: it returns an error string,
+		or None if the value is within its limits. Only the configured comparisons are evaluated, and the
+		value is parsed as a number only once. For a sub-sensor, the thresholds redefined for it are used '''
+		stringChecks = []
+		expected = self.getThreshold('ALARM_STRING_EQUAL', self.alarm_string_equal, sub, str)
+		if expected:
+			stringChecks.append(lambda v: 'value is "{}"'.format(v) if v == expected else None)
+		notExpected = self.getThreshold('ALARM_STRING_NOT_EQUAL', self.alarm_string_not_equal, sub, str)
+		if notExpected:
+			stringChecks.append(lambda v: 'value is "{}", but should be "{}"'.format(v, notExpected) if v != notExpected else None)
+
+		valueChecks = []
+		equal = self.getThreshold('ALARM_VALUE_EQUAL', self.alarm_value_equal, sub, float)
+		if equal is not None:
+			valueChecks.append(lambda v: 'value is {}'.format(v) if v == equal else None)
+		notEqual = self.getThreshold('ALARM_VALUE_NOT_EQUAL', self.alarm_value_not_equal, sub, float)
+		if notEqual is not None:
+			valueChecks.append(lambda v: 'value is {}, but should be {}'.format(v, notEqual) if v != notEqual else None)
+		moreThan = self.getThreshold('ALARM_VALUE_MORE_THAN', self.alarm_value_more_than, sub, float)
+		if moreThan is not None:
+			valueChecks.append(lambda v: 'value is {}, but should not exceed {}'.format(v, moreThan) if v > moreThan else None)
+		lessThan = self.getThreshold('ALARM_VALUE_LESS_THAN', self.alarm_value_less_than, sub, float)
+		if lessThan is not None:
+			valueChecks.append(lambda v: 'value is {}, but should be greater than {}'.format(v, lessThan) if v < lessThan else None)
+
+		def compare(detectedValue):
+			for check in stringChecks:
+				error = check(detectedValue)
+				if error:
+					return error
+			if not valueChecks:
+				return None
+			try:
+				value = locale.atof(detectedValue)
+			except ValueError:
+				return 'value "{}" is not a number'.format(detectedValue)
+			for check in valueChecks:
+				error = check(value)
+				if error:
+					return error
+			return None
+
+		return compare
+
+	def getComparator(self, sub=None):
+		''' Returns the comparator of the check or, if sub is given, of one of its sub-sensors (built at first use) '''
+		if sub is None:
+			return self.compare
+		comparator = self.subComparators.get(sub)
+		if comparator is None:
+			comparator = self.subComparators[sub] = self.buildComparator(sub)
+		return comparator
+
+	def getThreshold(self, key, defaultValue, sub, parse):
+		''' Returns the threshold of a sub-sensor: it can be redefined adding the sub-sensor name
+		in square brackets, e.g. ALARM_VALUE_MORE_THAN[load5]. Otherwise, the check one is used '''
+		if sub is None:
+			return defaultValue
+		val = self.getStr(self.name, '{}[{}]'.format(key, sub), None)
+		if val is None:
+			return defaultValue
+		return parse(val)
 
 	def getStr(self, name, key, defaultValue):
 		try:
@@ -337,7 +2262,23 @@ class Settings:
 			return defaultValue
 
 	def getInt(self, name, key, defaultValue):
-		return int(self.getStr(name, key, defaultValue))
+		val = self.getStr(name, key, None)
+		if val is None:
+			return defaultValue
+		return int(val)
+
+	def getFloat(self, name, key, defaultValue):
+		val = self.getStr(name, key, None)
+		if val is None:
+			return defaultValue
+		return float(val)
+
+	def getRegexp(self, name, key, defaultValue):
+		val = self.getStr(name, key, defaultValue)
+		try:
+			return re.compile(val, re.MULTILINE)
+		except re.error as e:
+			raise ValueError("Invalid regexp {} for configuration {}: {}".format(val, key, e))
 
 	def getBoolean(self, name, key, defaultValue):
 		try:
@@ -352,6 +2293,11 @@ class Settings:
 		return val
 
 
+def parseTime(value):
+	''' Parses a command line date/time to unix time '''
+	return datetime.datetime.fromisoformat(value).timestamp()
+
+
 if __name__ == '__main__':
 	import argparse
 
@@ -363,6 +2309,13 @@ if __name__ == '__main__':
 	parser.add_argument('configFile', help="configuration file path")
 	parser.add_argument('-q', '--quiet', action='store_true', help="suppress non-essential output")
 	parser.add_argument('-d', '--dry-run', action='store_true', help="do not send emails or execute completion script")
+	parser.add_argument('-D', '--daemon', action='store_true', help="keep running, executing every check on its own INTERVAL")
+	parser.add_argument('-C', '--collector', action='store_true', help="run as central collector, receiving the results from the\nhosts configured with PUSH_URL")
+	parser.add_argument('-F', '--flush-outbox', action='store_true', help="only send the pending notifications in OUTBOX_DIR and exit")
+	parser.add_argument('-H', '--history', metavar='CHECK', help="print the values detected by a check (stored in HISTORY_DIR) and exit")
+	parser.add_argument('--since', type=parseTime, default=0, help="with --history, print values detected from this date/time\n(e.g. 2022-05-31 or \"2022-05-31 10:40\")")
+	parser.add_argument('--until', type=parseTime, default=float('inf'), help="with --history, print values detected up to this date/time")
+	parser.add_argument('-P', '--profile', action='store_true', help="print the timings of the last run of every check, slowest first, and exit")
 	args = parser.parse_args()
 
 	if args.quiet:
@@ -373,7 +2326,18 @@ if __name__ == '__main__':
 
 	try:
 		main = Main(args.configFile)
-		main.run(args.dry_run)
+		if args.history:
+			main.printHistory(args.history, args.since, args.until)
+		elif args.profile:
+			main.printProfile()
+		elif args.collector:
+			main.collector(args.dry_run)
+		elif args.flush_outbox:
+			main.flushOutbox()
+		elif args.daemon:
+			main.daemon(args.dry_run)
+		else:
+			main.run(args.dry_run)
 	except Exception as e:
 		logging.critical(traceback.format_exc())
 		print('ERROR: {}'.format(e))
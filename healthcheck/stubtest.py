@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+""" @package docstring
+Healthcheck stub test
+
+Runs healthcheck against local stub servers, to check the notifications paths without sending any real
+email or touching any real device:
+- the stub SMTP server of benchmark.py, that can be started and stopped on a fixed port to simulate an outage
+- a stub esp32-lcd display, recording the frames it receives and the connections used to send them
+
+Scenarios:
+- outbox: a check in alarm while the SMTP server is down keeps its email in OUTBOX_DIR, then the email is
+  delivered (once) by the following runs, when the server is back
+- collector: pushes the results of a host to a --collector while the SMTP server is down: the batch must
+  be accepted anyway, and the alarm (with NOTIFY=START) must be notified by the first push after the
+  server is back, and only by that one
+- lcd: starts healthcheck with --daemon and changes the value detected by a check: the display must receive
+  a frame only when the text changes, always on the same kept-alive connection
+
+Every scenario runs healthcheck in its own process, with the status file in a temporary directory.
+
+Usage:
+python3 stubtest.py                       # runs all the scenarios, exits with 1 if any fails
+python3 stubtest.py --scenarios outbox    # runs only some scenarios
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import tempfile
+import threading
+import subprocess
+import http.server
+import urllib.parse
+import urllib.request
+import urllib.error
+
+from benchmark import StubSmtpServer
+
+
+NAME = 'stubtest'
+DESCRIPTION = 'Runs healthcheck against local stub SMTP and LCD servers'
+SCENARIOS = ['outbox', 'collector', 'lcd']
+PUSH_TOKEN = 'stubtest'
+# Max seconds to wait for a process to start or exit, or for a frame on the display
+WAIT_TIMEOUT_SECONDS = 10
+# Daemon mode: seconds to wait to be sure that a check ran at least twice
+CHECK_INTERVAL_SECONDS = 1
+STABLE_SECONDS = 2.5
+
+
+class Main:
+
+	def __init__(self, args):
+		self.args = args
+
+	def run(self):
+		''' Runs the scenarios and prints the results. Returns False if any failed '''
+		ok = True
+		for scenario in self.args.scenarios:
+			with tempfile.TemporaryDirectory() as tmpDir:
+				try:
+					error = getattr(self, 'scenario' + scenario.title())(tmpDir)
+				except Exception as e:
+					error = 'unexpected error: {}'.format(e)
+			print('{:<12} {}'.format(scenario, 'FAIL: ' + error if error else 'OK'))
+			ok = ok and not error
+		return ok
+
+	def scenarioOutbox(self, tmpDir):
+		''' Returns the error string, or None if succeeded '''
+		smtpPort = freePort()
+		outboxDir = os.path.join(tmpDir, 'outbox')
+		configPath = self.writeConfig(tmpDir, [
+			'MAILTO=root@localhost',
+			'SMTPHOST=127.0.0.1:{}'.format(smtpPort),
+			'OUTBOX_DIR={}'.format(outboxDir),
+			'[failing]',
+			'COMMAND=echo 10',
+			'REGEXP=(\\d+)',
+			'ALARM_VALUE_MORE_THAN=5',
+		])
+
+		# SMTP server down
+		error = self.runHealthcheck(tmpDir, configPath, 'run')
+		if error:
+			return error
+		pending = [ f for f in os.listdir(outboxDir) if f.endswith('.json') ]
+		if len(pending) != 1:
+			return 'expected 1 notification in the outbox, got {}'.format(len(pending))
+
+		smtp = StubSmtpServer(smtpPort)
+		try:
+			# Sent by the next runs, only once
+			for i in range(2):
+				error = self.runHealthcheck(tmpDir, configPath, 'run')
+				if error:
+					return error
+			if smtp.received != 1:
+				return 'expected 1 email after the SMTP server is back, got {}'.format(smtp.received)
+			pending = [ f for f in os.listdir(outboxDir) if f.endswith('.json') ]
+			if pending:
+				return 'outbox not empty after sending: {}'.format(pending)
+		finally:
+			smtp.shutdown()
+
+	def scenarioCollector(self, tmpDir):
+		''' Returns the error string, or None if succeeded '''
+		smtpPort = freePort()
+		collectorPort = freePort()
+		configPath = self.writeConfig(tmpDir, [
+			'MAILTO=root@localhost',
+			'SMTPHOST=127.0.0.1:{}'.format(smtpPort),
+			'NOTIFY=START',
+			'PUSH_TOKEN={}'.format(PUSH_TOKEN),
+			'COLLECTOR_ADDRESS=127.0.0.1:{}'.format(collectorPort),
+			'COLLECTOR_DB={}'.format(os.path.join(tmpDir, 'collector.db')),
+		])
+		proc = self.startHealthcheck(tmpDir, configPath, 'collector')
+		smtp = None
+		try:
+			if not waitListening(collectorPort):
+				return 'collector not listening'
+			url = 'http://127.0.0.1:{}/push'.format(collectorPort)
+			results = [ { 'check': 'disk', 'value': 99, 'error': 'disk full' } ]
+
+			code, body = push(url, 'wrong', 1, results)
+			if code != 403:
+				return 'expected the batch with a wrong token to be refused, got http {}'.format(code)
+
+			# SMTP server down: accepted anyway
+			code, body = push(url, PUSH_TOKEN, 1, results)
+			if code != 200 or body.get('accepted') != 1:
+				return 'batch not accepted while the SMTP server is down: http {} {}'.format(code, body)
+
+			smtp = StubSmtpServer(smtpPort)
+			for batchTime in (2, 3):
+				code, body = push(url, PUSH_TOKEN, batchTime, results)
+				if code != 200:
+					return 'batch not accepted: http {} {}'.format(code, body)
+			if smtp.received != 1:
+				return 'expected the alarm to be notified once after the SMTP server is back, got {} emails'.format(smtp.received)
+		finally:
+			proc.terminate()
+			proc.wait(WAIT_TIMEOUT_SECONDS)
+			if smtp:
+				smtp.shutdown()
+
+	def scenarioLcd(self, tmpDir):
+		''' Returns the error string, or None if succeeded '''
+		lcd = StubLcdServer()
+		valuePath = os.path.join(tmpDir, 'value')
+		setValue(valuePath, 1)
+		configPath = self.writeConfig(tmpDir, [
+			'LCD_URL=http://127.0.0.1:{}/'.format(lcd.port),
+			'LCD_MIN_INTERVAL=0',
+			'[value]',
+			'COMMAND=cat {}'.format(valuePath),
+			'REGEXP=(\\d+)',
+			'ALARM_VALUE_MORE_THAN=5',
+			'INTERVAL={}'.format(CHECK_INTERVAL_SECONDS),
+		])
+		proc = self.startHealthcheck(tmpDir, configPath, 'daemon')
+		try:
+			if not lcd.waitFrame('ALL OK'):
+				return 'no frame received at startup'
+			# The text doesn't change: nothing sent by the next runs
+			time.sleep(STABLE_SECONDS)
+			if len(lcd.frames) != 1:
+				return 'expected 1 frame with an unchanged status, got {}'.format(lcd.frames)
+
+			setValue(valuePath, 10)
+			if not lcd.waitFrame('1 ALARM'):
+				return 'alarm not shown on the display'
+			setValue(valuePath, 1)
+			if not lcd.waitFrame('ALL OK', 2):
+				return 'alarm end not shown on the display'
+			time.sleep(STABLE_SECONDS)
+			if len(lcd.frames) != 3:
+				return 'expected 3 frames, got {}'.format(lcd.frames)
+			if lcd.connections != 1:
+				return 'expected all the frames sent on the same connection, got {} connections'.format(lcd.connections)
+		finally:
+			proc.terminate()
+			proc.wait(WAIT_TIMEOUT_SECONDS)
+			lcd.shutdown()
+		if proc.returncode != 0:
+			return 'healthcheck exited with code {}'.format(proc.returncode)
+
+	def writeConfig(self, tmpDir, lines):
+		path = os.path.join(tmpDir, 'healthcheck.cfg')
+		with open(path, 'w') as f:
+			f.write('\n'.join([ '[DEFAULT]' ] + lines) + '\n')
+		return path
+
+	def startHealthcheck(self, tmpDir, configPath, mode):
+		cmd = [ sys.executable, os.path.abspath(__file__), '--healthcheck', configPath, os.path.join(tmpDir, 'healthcheck.tmp'), mode ]
+		return subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=None if self.args.verbose else subprocess.DEVNULL)
+
+	def runHealthcheck(self, tmpDir, configPath, mode):
+		''' Runs healthcheck until it exits, returns the error string, or None if succeeded '''
+		proc = self.startHealthcheck(tmpDir, configPath, mode)
+		proc.wait(WAIT_TIMEOUT_SECONDS)
+		if proc.returncode != 0:
+			return 'healthcheck exited with code {}'.format(proc.returncode)
+
+
+def runHealthcheck(configPath, statusPath, mode):
+	''' Internal: runs healthcheck in this process, with the status in statusPath '''
+	import logging
+	logging.basicConfig(level=logging.INFO)
+	os.environ.setdefault('LANG', 'C.UTF-8')
+	sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+	import healthcheck
+	healthcheck.STATUS_FILE = statusPath
+	# The failed notifications are retried by the next run, without waiting
+	healthcheck.OUTBOX_RETRY_SECONDS = 0
+	main = healthcheck.Main(configPath)
+	if mode == 'collector':
+		# Stopped by SIGTERM like by systemd
+		signal.signal(signal.SIGTERM, signal.SIG_DFL)
+		main.collector(False)
+	elif mode == 'daemon':
+		main.daemon(False)
+	else:
+		main.run(False)
+
+
+def freePort():
+	''' Returns a local port nobody is listening on '''
+	with socket.socket() as sock:
+		sock.bind(('127.0.0.1', 0))
+		return sock.getsockname()[1]
+
+
+def waitListening(port):
+	''' Waits for a server to listen on the local port, returns False if not listening in time '''
+	deadline = time.time() + WAIT_TIMEOUT_SECONDS
+	while time.time() < deadline:
+		try:
+			socket.create_connection(('127.0.0.1', port), WAIT_TIMEOUT_SECONDS).close()
+			return True
+		except ConnectionRefusedError:
+			time.sleep(0.1)
+	return False
+
+
+def push(url, token, batchTime, results):
+	''' Pushes a batch of results like a host with PUSH_URL, returns the http status and the json response '''
+	payload = json.dumps({ 'host': 'stubhost', 'time': batchTime, 'results': results }).encode()
+	headers = { 'Content-Type': 'application/json', 'Authorization': 'Bearer ' + token }
+	try:
+		with urllib.request.urlopen(urllib.request.Request(url, data=payload, headers=headers), timeout=WAIT_TIMEOUT_SECONDS) as response:
+			return response.status, json.loads(response.read())
+	except urllib.error.HTTPError as e:
+		return e.code, {}
+
+
+def setValue(path, value):
+	''' Sets the value printed by the command of the check '''
+	with open(path, 'w') as f:
+		f.write('{}\n'.format(value))
+
+
+class StubLcdServer:
+	''' A minimal esp32-lcd display, listening on a random local port: records the frames received and the
+	number of connections used to send them '''
+
+	def __init__(self):
+		stub = self
+		self.frames = []	# texts received, in arrival order
+		self.connections = 0
+		self.received = threading.Condition()
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+
+			def setup(self):
+				super().setup()
+				stub.connections += 1
+
+			def do_GET(self):
+				query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+				with stub.received:
+					stub.frames.append(query['message'][0])
+					stub.received.notify_all()
+				body = b'OK'
+				self.send_response(200)
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+		self.server.daemon_threads = True
+		self.port = self.server.server_address[1]
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+	def waitFrame(self, text, count=1):
+		''' Waits for the count-th frame starting with text, returns False if not received in time '''
+		with self.received:
+			return self.received.wait_for(lambda: sum(frame.startswith(text) for frame in self.frames) >= count, WAIT_TIMEOUT_SECONDS)
+
+	def shutdown(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		prog = NAME + '.py',
+		description = NAME + '\n' + DESCRIPTION,
+		formatter_class = argparse.RawTextHelpFormatter
+	)
+	parser.add_argument('--scenarios', nargs='+', default=SCENARIOS, choices=SCENARIOS, help="scenarios to run")
+	parser.add_argument('-v', '--verbose', action='store_true', help="print the healthcheck logs")
+	parser.add_argument('--healthcheck', nargs=3, help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.healthcheck:
+		# Internal: runs healthcheck with the given config, status file and mode
+		runHealthcheck(*args.healthcheck)
+		sys.exit(0)
+
+	sys.exit(0 if Main(args).run() else 1)
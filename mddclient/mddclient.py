@@ -45,17 +45,60 @@ import requests
 import re
 import datetime
 import json
+import threading
+import concurrent.futures
+import subprocess
+import ipaddress
+import queue
+import socket
+import select
+import signal
+import struct
+import time
+import hashlib
+import fcntl
 
 
 NAME = 'mddclient'
 VERSION = '0.2'
 DESCRIPTION = 'A DynamicDns client like ddclient, but supporting multiple (sub)domains'
 STATUS_FILE = '/tmp/mddclient.tmp'
-CHECKIP_REQUEST_ADDR = 'http://checkip.dyndns.org'
-CHECKIP_RESPONSE_PARSER = '<body>Current IP Address: (\d{1,3}.\d{1,3}.\d{1,3}.\d{1,3})</body>'
-DDCLIENT2_REQUEST_ADDR = "https://{}/nic/update?system=dyndns&hostname={}&myip={}"
-DDCLIENT2_RESPONSE_PARSER = '^(nochg|no_change|good) (\d{1,3}.\d{1,3}.\d{1,3}.\d{1,3})$'
+# A run started while the previous one is still running checks every these seconds if it ended
+RUN_LOCK_POLL_SECONDS = 1
+# Services returning the current public IP address, queried all together: the first answer wins
+CHECKIP_REQUEST_ADDRS = 'http://checkip.dyndns.org, https://api.ipify.org, https://ipv4.icanhazip.com'
+CHECKIP6_REQUEST_ADDRS = 'https://api6.ipify.org, https://ipv6.icanhazip.com'
+# Finds an IP address in the checkip response (validated later)
+CHECKIP_RESPONSE_PARSER = '[0-9a-fA-F:.]*[:.][0-9a-fA-F:.]+'
+DDCLIENT2_REQUEST_ADDR = "https://{}/nic/update"
+DDCLIENT2_RESPONSE_PARSER = '^(nochg|no_change|good) ([0-9a-fA-F:., ]+)$'
+# Max domains updated with a single request (BATCH=True), as per dyndns2 specification
+BATCH_MAX_HOSTS = 20
 USER_AGENT = 'Selfhost Utils Mddclient ' + VERSION
+# Seconds to wait for the connection to the server and for its response
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+# dyndns2 result codes: temporary server errors, retried waiting more and more between attempts (from
+# RETRY_MIN_SECONDS up to RETRY_MAX_SECONDS), and errors that can't be solved retrying (the domain is not updated
+# anymore until its config changes or the update is forced)
+RETRY_RESULT_CODES = ('911', 'dnserr')
+PERMANENT_RESULT_CODES = ('badauth', 'nohost', 'abuse', 'notfqdn', '!donator', 'badagent')
+RETRY_MIN_SECONDS = 600
+RETRY_MAX_SECONDS = 6 * 3600
+# DNS verification (VERIFY_DNS=True): max concurrent queries and max seconds the answers are cached
+DNS_MAX_PARALLEL = 16
+DNS_CACHE_MAX_SECONDS = 60
+# A domain updated by this client is updated again because of a DNS mismatch only after its record TTL, and no more
+# often than this (the DNS server may be slow to publish the new address, or not publish it at all)
+DNS_DRIFT_MIN_SECONDS = 3600
+DNS_PORT = 53
+RESOLV_CONF = '/etc/resolv.conf'
+# Daemon mode: seconds between two checks of the current IP, if no network change event is received
+DEFAULT_POLL_INTERVAL = 900
+# Daemon mode: seconds without network change events to wait before checking the IP (to coalesce bursts of events)
+DEFAULT_DEBOUNCE = 2
+# Daemon mode: the status is saved at least once in this interval (and after every update)
+DAEMON_STATUS_SAVE_SECONDS = 3600
 
 class Main:
 
@@ -69,87 +112,359 @@ class Main:
 		self.config = configparser.ConfigParser()
 		self.config.read(configPath)
 
+		self.sessions = {}	# key-value, server : requests.Session (keeping the connections alive between requests)
+		self.serverSlots = {}	# key-value, server : semaphore limiting the concurrent requests to the server
+		self._sessionsLock = threading.Lock()
+		self.noBatchServers = set()	# servers that answered numhost to a batch request
+		self.resolver = None	# DnsResolver, kept between the runs in daemon mode (for its cache)
+
 	def run(self, force, printStatusAndExit):
 		''' Makes the update requests '''
 
-		# Load status
-		status = Status()
-
 		if printStatusAndExit:
-			status.print()
+			Status().print()
+			return True
+
+		runLock = RunLock(STATUS_FILE)
+		if not runLock.acquire(wait=True):
+			self._log.warning('Skipping run: the previous one is still running')
 			return True
 
-		# Check current ip
-		currentIp = self.getCurrentIp()
+		try:
+			# Load status (only now, to get the changes made by the previous run)
+			status = Status()
+			success, updated = self.checkAndUpdate(status, force)
+			status.save(success, updated)
+		finally:
+			runLock.release()
+		return success
+
+	def daemon(self, force):
+		''' Keeps running, updating the domains as soon as the network configuration changes (an address is
+		assigned or removed, the default route changes), or at least every POLL_INTERVAL seconds.
+		An update can be triggered sending SIGUSR1, too '''
+		pollInterval = self.config.getfloat('DEFAULT', 'POLL_INTERVAL', fallback=DEFAULT_POLL_INTERVAL)
+		debounce = self.config.getfloat('DEFAULT', 'DEBOUNCE', fallback=DEFAULT_DEBOUNCE)
+
+		# The lock is kept as long as the daemon runs, so any run started by cron is skipped
+		runLock = RunLock(STATUS_FILE)
+		if not runLock.acquire(wait=False, daemon=True):
+			raise RuntimeError('another {} is already running with status file {}'.format(NAME, STATUS_FILE))
+
+		# The status is kept in memory, and saved only from time to time
+		status = Status()
+		events = NetworkEvents()
+		self._stopRequested = False
+		def stop(signum, frame):
+			self._log.info('Received signal {}, stopping'.format(signum))
+			self._stopRequested = True
+			events.trigger()
+		signal.signal(signal.SIGTERM, stop)
+		signal.signal(signal.SIGINT, stop)
+		signal.signal(signal.SIGUSR1, lambda signum, frame: events.trigger())
+
+		lastSave = time.monotonic()
+		nextPoll = 0	# The IP is checked immediately at startup
+		try:
+			while True:
+				if events.wait(max(nextPoll - time.monotonic(), 0)):
+					# Wait for the network configuration to settle: a reconnection produces several events
+					while events.wait(debounce) and not self._stopRequested:
+						pass
+				if self._stopRequested:
+					break
+
+				self._log.info('Checking the current IP')
+				success, updated = self.checkAndUpdate(status, force)
+				status.setRunResult(success, updated)
+				force = False
+				nextPoll = time.monotonic() + pollInterval
+				nextRetry = status.getNextRetry([ section for section in self.config if section != 'DEFAULT' ], time.time())
+				if nextRetry is not None:
+					# Retry the failed domains as soon as their retry time has come (but never spin, if the
+					# retry could not happen, e.g. because the current IP could not be detected)
+					nextPoll = min(nextPoll, time.monotonic() + max(nextRetry - time.time(), debounce, 1))
+
+				if updated or time.monotonic() - lastSave >= DAEMON_STATUS_SAVE_SECONDS:
+					status.write()
+					lastSave = time.monotonic()
+		finally:
+			status.write()
+			events.close()
+			runLock.release()
+
+	def checkAndUpdate(self, status, force):
+		''' Checks the current IP and updates the domains not up-to-date. Every domain is updated only if its IP
+		changed or its previous update failed (and its retry time has come). Returns a tuple (success, updated):
+		success is False if any domain is not up-to-date '''
+		sections = [ Settings(section, self.config) for section in self.config if section != 'DEFAULT' ]
+
+		# Check current ip (only the IPv4 and IPv6 addresses needed by the configured domains)
+		currentIp = self.getCurrentIp(any(s.ipv4 for s in sections), any(s.ipv6 for s in sections))
 		if (currentIp == None):
-			return False
+			return False, False
 
-		self._log.info('Current ip is {}'.format(currentIp))
+		self._log.info('Current ip is {}'.format(', '.join(ip for ip in currentIp if ip)))
+		if force:
+			self._log.info('User requested forced refresh.')
 
-		if currentIp == status.getIp():
-			self._log.info('Ip is up-to-date.')
-			if force:
-				self._log.info('User requested forced refresh.')
-			else:
-				self._log.info('Nothing to do.')
-				status.save(True, False)
-				return
+		now = time.time()
+		verified = {}
+		if self.config.getboolean('DEFAULT', 'VERIFY_DNS', fallback=False):
+			# Check the addresses currently published: the status may be lost (e.g. after a reboot) or outdated
+			verified = self.verifyDomains(sections, currentIp)
+		toUpdate = []
+		for s in sections:
+			if force or self.needsUpdate(s, s.filterIp(currentIp), status, now, verified.get(s.name)):
+				toUpdate.append(s)
+			elif verified.get(s.name, (False, 0))[0] and not status.isDomainUpToDate(s.name, s.fingerprint(), s.filterIp(currentIp)):
+				# Already pointing to the current address, even if not updated by this client
+				status.setDomainResult(s.name, s.fingerprint(), s.filterIp(currentIp), 'good', None)
+		if not toUpdate:
+			self._log.info('Nothing to do.')
 
-		success = True
 		updated = False
-		for section in self.config:
-			s = Settings(section, self.config)
-			if s.name == 'DEFAULT':
-				continue
+		maxParallel = self.config.getint('DEFAULT', 'MAX_PARALLEL', fallback=4)
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max(maxParallel, 1)) as executor:
+			futures = [ executor.submit(self.updateSections, batch, currentIp) for batch in self.groupBatches(toUpdate, currentIp) ]
+			outcomes = {}	# key-value, section name : updated address, or the exception if failed
+			for future in futures:
+				outcomes.update(future.result())
 
-			self._log.info('Updating "{}"'.format(section))
-			try:
-				newIpAddr = self.update(s.ddserver, s.dduser, s.ddpass, s.domain, currentIp)
-				self._log.info('Success update {} to addr {}'.format(s.domain, newIpAddr))
+		# The results are logged in config order
+		for s in toUpdate:
+			outcome = outcomes[s.name]
+			if isinstance(outcome, Exception):
+				self._log.error('Error while updating {}: {}'.format(s.domain, outcome))
+				self.setDomainError(s, status, getattr(outcome, 'code', None), now)
+			else:
+				self._log.info('Success update {} to addr {}'.format(s.domain, outcome))
+				status.setDomainResult(s.name, s.fingerprint(), s.filterIp(currentIp), 'good', None)
 				updated = True
-			except Exception as e:
-				self._log.error('Error while updating {}: {}'.format(s.domain, e))
-				success = False
+				if self.resolver:
+					self.resolver.invalidate(s.domain)
+
+		success = all(status.isDomainUpToDate(s.name, s.fingerprint(), s.filterIp(currentIp)) for s in sections)
 
 		# Save current ip
 		if success:
 			status.setIp(currentIp)
 
-		status.save(success, updated)
+		return success, updated
 
-		return success
+	def needsUpdate(self, s, ip, status, now, verified=None):
+		''' Decides if a domain must be updated, based on the result of its previous update and, with VERIFY_DNS,
+		on the addresses published in the DNS (verified is the tuple returned by verifyDomains, or None) '''
+		state = status.getDomain(s.name)
+		# If never updated, or the config changed, the previous result doesn't apply anymore
+		if state is not None and state['config'] == s.fingerprint():
+			if state['result'] in PERMANENT_RESULT_CODES:
+				self._log.error('Not updating {}: the previous update failed with "{}". Fix the config or force the update'.format(s.domain, state['result']))
+				return False
+			if state['nextRetry'] is not None and now < state['nextRetry']:
+				self._log.info('Not updating {}: waiting until {} to retry'.format(s.domain, datetime.datetime.fromtimestamp(state['nextRetry'])))
+				return False
+
+		upToDate = status.isDomainUpToDate(s.name, s.fingerprint(), ip)
+		if verified is None:
+			return not upToDate
+
+		matches, ttl = verified
+		if matches:
+			return False
+		if upToDate and state is not None and now - state.get('time', 0) < max(ttl, DNS_DRIFT_MIN_SECONDS):
+			# Updated recently: the resolver may return the previous address until the record TTL expires
+			self._log.info('{} was updated, but the DNS still returns a different address'.format(s.domain))
+			return False
+		self._log.info('{} doesn\'t point to the current address'.format(s.domain))
+		return True
+
+	def verifyDomains(self, sections, ip):
+		''' Resolves the domains concurrently. Returns a dict section name : tuple (matches, ttl): matches is True
+		if the domain already points to the current addresses, ttl is the max TTL of its records. The domains that
+		couldn't be resolved are missing (their status is used instead) '''
+		resolver = self.getResolver()
 
-	def getCurrentIp(self):
-		'''Obtains current IP from checkip.dyndns.org'''
-		response = requests.get(CHECKIP_REQUEST_ADDR)
+		def verify(s):
+			matches = True
+			ttl = 0
+			for version, address in zip((4, 6), s.filterIp(ip)):
+				if address is None:
+					continue
+				try:
+					addresses, recordTtl = resolver.resolve(s.domain, version)
+				except (OSError, DnsError) as e:
+					self._log.warning('Unable to resolve {}: {}'.format(s.domain, e))
+					return None
+				matches = matches and address in addresses
+				ttl = max(ttl, recordTtl)
+			return matches, ttl
 
-		match = re.search(CHECKIP_RESPONSE_PARSER, response.text, re.MULTILINE)
-		if not match:
-			self._log.error('Unable to obtain new IP addr: Response format not valid: {}'.format(response.text))
-			return
-		groups = match.groups()
-		if len(groups) != 1:
-			self._log.error('Unable to obtain new IP addr: Unable to parse response: {}'.format(response.text))
-			return
+		with concurrent.futures.ThreadPoolExecutor(max_workers=min(max(len(sections), 1), DNS_MAX_PARALLEL)) as executor:
+			results = list(executor.map(verify, sections))
+		return { s.name: result for s, result in zip(sections, results) if result is not None }
 
-		return groups[0]
+	def getResolver(self):
+		''' Returns the resolver querying the DNS server in RESOLVER (host or host:port), or the system one '''
+		if not self.resolver:
+			server = self.config.get('DEFAULT', 'RESOLVER', fallback=None)
+			if server is None:
+				server = DnsResolver.systemServer()
+			host, port = server, DNS_PORT
+			if server.startswith('['):
+				# IPv6 address with port: [::1]:53
+				host, _, port = server[1:].partition(']:')
+			elif server.count(':') == 1:
+				host, _, port = server.partition(':')
+			timeout = self.config.getfloat('DEFAULT', 'CONNECT_TIMEOUT', fallback=DEFAULT_CONNECT_TIMEOUT)
+			self.resolver = DnsResolver(host, int(port), timeout)
+		return self.resolver
 
-	def update(self, server, user, password, domain, ip):
-		apiUrl = DDCLIENT2_REQUEST_ADDR.format(server, domain, ip)
+	def setDomainError(self, s, status, code, now):
+		''' Records a failed update: temporary server errors are retried with exponential backoff '''
+		state = status.getDomain(s.name)
+		failures = state['failures'] + 1 if state and state['config'] == s.fingerprint() else 1
+		# The domain still points to the previous address
+		ip = state['ip'] if state else None
+		nextRetry = None
+		if code in RETRY_RESULT_CODES:
+			nextRetry = now + min(RETRY_MIN_SECONDS * 2 ** (failures - 1), RETRY_MAX_SECONDS)
+			self._log.warning('{} will be retried after {}'.format(s.domain, datetime.datetime.fromtimestamp(nextRetry)))
+		elif code in PERMANENT_RESULT_CODES:
+			self._log.error('{} will not be updated anymore, until its config changes or the update is forced'.format(s.domain))
+		status.setDomainResult(s.name, s.fingerprint(), ip, code or 'error', nextRetry, failures)
+
+	def getCurrentIp(self, ipv4, ipv6):
+		''' Obtains the current IPv4 and IPv6 addresses (only the requested ones) from the configured IP_SOURCES.
+		Returns a tuple (ipv4, ipv6), or None if a requested address couldn't be obtained '''
+		detector = IpDetector(self.config)
+		currentIp = []
+		for version, needed in ((4, ipv4), (6, ipv6)):
+			ip = detector.detect(version) if needed else None
+			if needed and ip is None:
+				self._log.error('Unable to obtain new IPv{} addr from {}'.format(version, ', '.join(detector.sources)))
+				return None
+			currentIp.append(ip)
+		return tuple(currentIp)
+
+	def groupBatches(self, sections, ip):
+		''' Groups the sections with BATCH=True that can be updated with a single request: same server, credentials
+		and addresses. Returns a list of lists of sections (the ones without BATCH are alone in their list) '''
+		batches = []
+		groups = {}
+		for s in sections:
+			if not s.batch or s.ddserver in self.noBatchServers:
+				batches.append([ s ])
+				continue
+			key = (s.ddserver, s.dduser, s.ddpass, s.filterIp(ip))
+			if key not in groups or len(groups[key]) == BATCH_MAX_HOSTS:
+				groups[key] = []
+				batches.append(groups[key])
+			groups[key].append(s)
+		return batches
+
+	def updateSections(self, sections, ip):
+		''' Updates the domains of the sections, with a single request if more than one. If the server doesn't
+		accept more domains in a request, they are updated one by one. Returns a dict section name : updated
+		address, or the exception if failed '''
+		if len(sections) > 1:
+			try:
+				return self.updateBatch(sections, ip)
+			except UpdateError as e:
+				if e.code != 'numhost':
+					return { s.name: e for s in sections }
+				self._log.warning('Server {} doesn\'t accept more domains in a request: updating them one by one'.format(sections[0].ddserver))
+				self.noBatchServers.add(sections[0].ddserver)
+			except Exception as e:
+				return { s.name: e for s in sections }
+
+		outcomes = {}
+		for s in sections:
+			try:
+				outcomes[s.name] = self.updateSection(s, ip)
+			except Exception as e:
+				outcomes[s.name] = e
+		return outcomes
+
+	def updateBatch(self, sections, ip):
+		''' Updates more domains (of the same server and account) with a single request. Returns a dict section name :
+		updated address, or the UpdateError for that domain. Raises UpdateError if the whole request failed '''
+		s = sections[0]
+		with self.getServerSlot(s.ddserver, s.maxParallelPerServer):
+			self._log.info('Updating {} with a single request'.format(', '.join('"{}"'.format(x.name) for x in sections)))
+			text = self.request(s.ddserver, s.dduser, s.ddpass, ','.join(x.domain for x in sections), s.filterIp(ip), (s.connectTimeout, s.readTimeout))
+
+		# One result line for every domain, in the same order
+		lines = text.strip().splitlines()
+		if len(lines) == 1 and len(sections) > 1:
+			# A single result for the whole request (e.g. badauth or numhost)
+			self.parseResponse(lines[0])
+			lines = lines * len(sections)
+		if len(lines) != len(sections):
+			raise UpdateError(None, 'Response contains {} results for {} domains: {}'.format(len(lines), len(sections), text))
+
+		outcomes = {}
+		for section, line in zip(sections, lines):
+			try:
+				outcomes[section.name] = self.parseResponse(line)
+			except UpdateError as e:
+				outcomes[section.name] = e
+		return outcomes
+
+	def updateSection(self, s, ip):
+		''' Updates the domain of a section, waiting if there are already MAX_PARALLEL_PER_SERVER requests to its server '''
+		# Only the addresses enabled for this domain are sent
+		ip = s.filterIp(ip)
+		with self.getServerSlot(s.ddserver, s.maxParallelPerServer):
+			self._log.info('Updating "{}"'.format(s.name))
+			return self.update(s.ddserver, s.dduser, s.ddpass, s.domain, ip, (s.connectTimeout, s.readTimeout))
+
+	def getServerSlot(self, server, maxParallel):
+		''' Returns the semaphore limiting the concurrent requests to a server '''
+		with self._sessionsLock:
+			if server not in self.serverSlots:
+				self.serverSlots[server] = threading.BoundedSemaphore(max(maxParallel, 1))
+			return self.serverSlots[server]
+
+	def getSession(self, server):
+		''' Returns the session used for all the requests to a server, so the connection (and the TLS handshake)
+		is reused by the following requests '''
+		with self._sessionsLock:
+			if server not in self.sessions:
+				session = requests.Session()
+				session.headers['User-Agent'] = USER_AGENT
+				self.sessions[server] = session
+			return self.sessions[server]
+
+	def update(self, server, user, password, domain, ip, timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)):
+		''' Updates a domain with the ip, a tuple (ipv4, ipv6): the None addresses are not sent '''
+		return self.parseResponse(self.request(server, user, password, domain, ip, timeout))
+
+	def request(self, server, user, password, hostname, ip, timeout):
+		''' Sends the update request for the hostname (or comma-separated hostnames): returns the response text '''
+		apiUrl = DDCLIENT2_REQUEST_ADDR.format(server)
+		params = { 'system': 'dyndns', 'hostname': hostname }
+		if ip[0]:
+			params['myip'] = ip[0]
+		if ip[1]:
+			params['myipv6'] = ip[1]
 		try:
-			response = requests.get(apiUrl, auth=(user, password), headers={"User-Agent": USER_AGENT})
+			response = self.getSession(server).get(apiUrl, params=params, auth=(user, password), timeout=timeout)
+		except requests.Timeout:
+			raise UpdateError(None, 'Server {} did not answer in time (connect timeout {}s, read timeout {}s)'.format(server, *timeout))
 		except requests.ConnectionError:
-			raise Exception('Server {} is unreachable'.format(server))
+			raise UpdateError(None, 'Server {} is unreachable'.format(server))
 
-		match = re.search(DDCLIENT2_RESPONSE_PARSER, response.text)
-		if not match:
-			raise Exception('Response format not valid: {}'.format(response.text))
-		groups = match.groups()
-		if len(groups) != 2:
-			raise Exception('Unable to parse response: {}'.format(response.text))
+		return response.text
 
-		operationResult = groups[0]
-		ipAddr = groups[1]
+	def parseResponse(self, text):
+		''' Parses the server response: returns the updated address, or raises an UpdateError with the result code '''
+		match = re.search(DDCLIENT2_RESPONSE_PARSER, text)
+		if match:
+			operationResult, ipAddr = match.groups()
+		else:
+			# The error result codes are returned without address
+			operationResult, ipAddr = text.strip(), None
 
 		# Check operation result and return appropriate errors
 		if operationResult == 'good':
@@ -160,25 +475,375 @@ class Main:
 			self._log.warning('Ip addres didn\'t need update: this should happen only at first run')
 			return ipAddr
 		elif operationResult == 'badauth':
-			raise Exception('The username and password pair do not match a real user')
+			raise UpdateError(operationResult, 'The username and password pair do not match a real user')
 		elif operationResult == '!donator':
-			raise Exception('Option available only to credited users, but the user is not a credited user')
+			raise UpdateError(operationResult, 'Option available only to credited users, but the user is not a credited user')
 		elif operationResult == 'notfqdn':
-			raise Exception('The hostname specified is not a fully-qualified domain name (not in the form hostname.dyndns.org or domain.com).')
+			raise UpdateError(operationResult, 'The hostname specified is not a fully-qualified domain name (not in the form hostname.dyndns.org or domain.com).')
 		elif operationResult == 'nohost':
-			raise Exception('The hostname specified does not exist in this user account')
+			raise UpdateError(operationResult, 'The hostname specified does not exist in this user account')
 		elif operationResult == 'numhost':
-			raise Exception('Too many hosts specified in an update')
+			raise UpdateError(operationResult, 'Too many hosts specified in an update')
 		elif operationResult == 'abuse':
-			raise Exception('The hostname specified is blocked for update abuse')
+			raise UpdateError(operationResult, 'The hostname specified is blocked for update abuse')
 		elif operationResult == 'badagent':
-			raise Exception('The user agent was not sent or HTTP method is not permitted')
+			raise UpdateError(operationResult, 'The user agent was not sent or HTTP method is not permitted')
 		elif operationResult == 'dnserr':
-			raise Exception('DNS error encountered')
+			raise UpdateError(operationResult, 'DNS error encountered')
 		elif operationResult == '911':
-			raise Exception('There is a problem or scheduled maintenance on server side')
+			raise UpdateError(operationResult, 'There is a problem or scheduled maintenance on server side')
 		else:
-			raise Exception('Server returned an unknown result code: {}'.format(operationResult))
+			raise UpdateError(None, 'Server returned an unknown result code: {}'.format(operationResult))
+
+
+class DnsResolver:
+	''' A minimal DNS client, resolving the A and AAAA records with a configurable DNS server (e.g. the authoritative
+	one of the domains, whose answers are always up-to-date). The answers are cached for their TTL, but no more than
+	DNS_CACHE_MAX_SECONDS '''
+
+	QTYPES = { 4: 1, 6: 28 }	# A, AAAA
+	FAMILIES = { 4: socket.AF_INET, 6: socket.AF_INET6 }
+	HEADER = struct.Struct('>HHHHHH')	# id, flags, questions, answers, authorities, additionals
+	RECORD = struct.Struct('>HHLH')	# type, class, ttl, data length
+	RCODE_NXDOMAIN = 3
+
+	def __init__(self, host, port, timeout):
+		self.host = host
+		self.port = port
+		self.timeout = timeout
+		self.cache = {}	# key-value, (name, version) : (expiration time, addresses, ttl)
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def systemServer():
+		''' Returns the first DNS server configured in the system '''
+		try:
+			with open(RESOLV_CONF, 'r') as f:
+				for line in f:
+					fields = line.split()
+					if len(fields) >= 2 and fields[0] == 'nameserver':
+						return fields[1]
+		except OSError:
+			pass
+		return '127.0.0.1'
+
+	def resolve(self, name, version):
+		''' Returns the addresses of the version (4 or 6) of a domain, with their TTL: a tuple (addresses list, ttl) '''
+		key = (name, version)
+		with self._lock:
+			cached = self.cache.get(key)
+		if cached and cached[0] > time.monotonic():
+			return cached[1], cached[2]
+
+		addresses, ttl = self.query(name, version)
+		with self._lock:
+			self.cache[key] = (time.monotonic() + min(ttl, DNS_CACHE_MAX_SECONDS), addresses, ttl)
+		return addresses, ttl
+
+	def invalidate(self, name):
+		''' Forgets the cached answers of a domain (e.g. just updated) '''
+		with self._lock:
+			for version in self.QTYPES:
+				self.cache.pop((name, version), None)
+
+	def query(self, name, version):
+		qid = int.from_bytes(os.urandom(2), 'big')
+		qtype = self.QTYPES[version]
+		question = b''.join(bytes([len(label)]) + label for label in name.rstrip('.').encode('idna').split(b'.'))
+		request = self.HEADER.pack(qid, 0x0100, 1, 0, 0, 0) + question + b'\0' + struct.pack('>HH', qtype, 1)
+
+		family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+		with socket.socket(family, socket.SOCK_DGRAM) as sock:
+			sock.settimeout(self.timeout)
+			sock.sendto(request, (self.host, self.port))
+			while True:
+				data, _ = sock.recvfrom(4096)
+				# Late answers to previous queries are ignored
+				if len(data) >= self.HEADER.size and self.HEADER.unpack_from(data)[0] == qid:
+					break
+
+		try:
+			_, flags, questions, answers, _, _ = self.HEADER.unpack_from(data)
+			rcode = flags & 0xF
+			if rcode == self.RCODE_NXDOMAIN:
+				return [], 0
+			if rcode != 0:
+				raise DnsError('the DNS server answered with error code {}'.format(rcode))
+
+			offset = self.HEADER.size
+			for i in range(questions):
+				offset = self.skipName(data, offset) + 4
+			addresses = []
+			ttl = None
+			for i in range(answers):
+				offset = self.skipName(data, offset)
+				rtype, _, rttl, length = self.RECORD.unpack_from(data, offset)
+				offset += self.RECORD.size
+				# Other records (e.g. CNAME) are skipped
+				if rtype == qtype:
+					addresses.append(socket.inet_ntop(self.FAMILIES[version], data[offset:offset + length]))
+					ttl = rttl if ttl is None else min(ttl, rttl)
+				offset += length
+			return addresses, ttl or 0
+		except (struct.error, ValueError, IndexError) as e:
+			raise DnsError('invalid answer from the DNS server: {}'.format(e))
+
+	@staticmethod
+	def skipName(data, offset):
+		''' Returns the offset after the (possibly compressed) domain name starting at offset '''
+		while True:
+			length = data[offset]
+			if length & 0xC0 == 0xC0:
+				# Pointer to a name elsewhere in the message
+				return offset + 2
+			if length == 0:
+				return offset + 1
+			offset += length + 1
+
+
+class DnsError(Exception):
+	pass
+
+
+class UpdateError(Exception):
+	''' A failed update: code is the result code returned by the server (None if not received) '''
+
+	def __init__(self, code, message):
+		super().__init__(message)
+		self.code = code
+
+
+class IpDetector:
+	''' Obtains the current IP address from the sources configured in IP_SOURCES, in order:
+	- interface: the global addresses assigned to the network interfaces (for hosts with a public IP)
+	- http: the checkip services, queried concurrently: the first valid answer wins '''
+
+	def __init__(self, config):
+		self._log = logging.getLogger('ipdetector')
+		self.sources = [ x.strip() for x in config.get('DEFAULT', 'IP_SOURCES', fallback='http').split(',') ]
+		for source in self.sources:
+			if source not in ('interface', 'http'):
+				raise ValueError('Invalid value {} for configuration IP_SOURCES: expected interface or http'.format(source))
+		self.interface = config.get('DEFAULT', 'INTERFACE', fallback=None)
+		self.checkipUrls = {
+			4: [ x.strip() for x in config.get('DEFAULT', 'CHECKIP_URLS', fallback=CHECKIP_REQUEST_ADDRS).split(',') ],
+			6: [ x.strip() for x in config.get('DEFAULT', 'CHECKIP6_URLS', fallback=CHECKIP6_REQUEST_ADDRS).split(',') ],
+		}
+		self.timeout = (
+			config.getfloat('DEFAULT', 'CONNECT_TIMEOUT', fallback=DEFAULT_CONNECT_TIMEOUT),
+			config.getfloat('DEFAULT', 'READ_TIMEOUT', fallback=DEFAULT_READ_TIMEOUT),
+		)
+
+	def detect(self, version):
+		''' Returns the current IP address of the version (4 or 6), or None '''
+		for source in self.sources:
+			if source == 'interface':
+				ip = self.fromInterface(version)
+			else:
+				ip = self.fromCheckip(version)
+			if ip:
+				return ip
+			self._log.warning('Unable to obtain the IPv{} addr from {}'.format(version, source))
+		return None
+
+	def fromInterface(self, version):
+		''' Returns the first public address assigned to the network interfaces (or to INTERFACE) '''
+		cmd = [ 'ip', '-o', '-{}'.format(version), 'addr', 'show', 'scope', 'global' ]
+		if self.interface:
+			cmd += [ 'dev', self.interface ]
+		try:
+			ret = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=self.timeout[1])
+		except (OSError, subprocess.TimeoutExpired) as e:
+			self._log.error('Unable to list the interfaces addresses: {}'.format(e))
+			return None
+		for line in ret.stdout.decode().splitlines():
+			fields = line.split()
+			if 'temporary' in fields or 'deprecated' in fields:
+				# IPv6 privacy addresses change often and are not meant to be published
+				continue
+			ip = self.validate(fields[3].split('/')[0], version)
+			if ip:
+				return ip
+		return None
+
+	def fromCheckip(self, version):
+		''' Queries all the checkip services at the same time and returns the first valid answer. The slower ones are
+		abandoned (they run in daemon threads, so they don't prevent the program from exiting) '''
+		answers = queue.Queue()
+		urls = self.checkipUrls[version]
+		for url in urls:
+			threading.Thread(target=lambda url=url: answers.put(self.queryCheckip(url, version)), daemon=True).start()
+		for i in range(len(urls)):
+			ip = answers.get()
+			if ip:
+				return ip
+		return None
+
+	def queryCheckip(self, url, version):
+		try:
+			response = requests.get(url, headers={"User-Agent": USER_AGENT}, timeout=self.timeout)
+		except requests.RequestException as e:
+			self._log.info('Unable to obtain new IP addr from {}: {}'.format(url, e))
+			return None
+		# Decoded as ascii: without a declared charset, guessing the encoding of a short response may fail
+		text = response.content.decode('ascii', errors='replace')
+		for candidate in re.findall(CHECKIP_RESPONSE_PARSER, text):
+			ip = self.validate(candidate, version)
+			if ip:
+				return ip
+		self._log.info('Unable to obtain new IP addr from {}: Response format not valid: {}'.format(url, text))
+		return None
+
+	def validate(self, candidate, version):
+		''' Returns the address, if it is a valid public address of the version, or None '''
+		try:
+			ip = ipaddress.ip_address(candidate)
+		except ValueError:
+			return None
+		if ip.version != version or not ip.is_global:
+			return None
+		return str(ip)
+
+
+class NetworkEvents:
+	''' Receives from the kernel (via netlink) the network configuration changes that may change the public IP:
+	global addresses assigned or removed and default route changes. If netlink is not available (e.g. not on Linux),
+	no event is received. The events can be simulated with trigger() '''
+
+	RTMGRP_IPV4_IFADDR = 0x10
+	RTMGRP_IPV4_ROUTE = 0x40
+	RTMGRP_IPV6_IFADDR = 0x100
+	RTMGRP_IPV6_ROUTE = 0x400
+	RTM_NEWADDR, RTM_DELADDR, RTM_NEWROUTE, RTM_DELROUTE = 20, 21, 24, 25
+	NLMSGHDR = struct.Struct('=LHHLL')	# length, type, flags, sequence, pid
+	IFADDRMSG = struct.Struct('=BBBBL')	# family, prefix length, flags, scope, interface index
+	RTMSG = struct.Struct('=BBBBBBBBL')	# family, destination length, source length, tos, table, protocol, scope, type, flags
+	RT_SCOPE_UNIVERSE = 0
+
+	def __init__(self):
+		self._log = logging.getLogger('networkevents')
+		# Used to wake up wait() from trigger() (e.g. called by a signal handler)
+		self.wakeUpReader, self.wakeUpWriter = socket.socketpair()
+		self.wakeUpWriter.setblocking(False)
+		try:
+			self.netlink = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+			self.netlink.bind((0, self.RTMGRP_IPV4_IFADDR | self.RTMGRP_IPV4_ROUTE | self.RTMGRP_IPV6_IFADDR | self.RTMGRP_IPV6_ROUTE))
+		except (AttributeError, OSError) as e:
+			self._log.warning('Unable to receive the network change events, polling only: {}'.format(e))
+			self.netlink = None
+
+	def trigger(self):
+		''' Simulates a network change event '''
+		try:
+			self.wakeUpWriter.send(b'\0')
+		except BlockingIOError:
+			pass	# Already triggered
+
+	def wait(self, timeout):
+		''' Waits up to timeout seconds for a network change event. Returns True if received '''
+		sockets = [ self.wakeUpReader ] + ([ self.netlink ] if self.netlink else [])
+		deadline = time.monotonic() + timeout
+		while True:
+			readable, _, _ = select.select(sockets, [], [], max(deadline - time.monotonic(), 0))
+			if not readable:
+				return False
+			received = False
+			if self.wakeUpReader in readable:
+				self.wakeUpReader.recv(4096)
+				received = True
+			if self.netlink in readable:
+				received = self.isRelevant(self.netlink.recv(65536)) or received
+			if received:
+				return True
+
+	def isRelevant(self, data):
+		''' Returns True if the netlink messages contain a change of a global address or of the default route '''
+		offset = 0
+		while offset + self.NLMSGHDR.size <= len(data):
+			length, msgType, _, _, _ = self.NLMSGHDR.unpack_from(data, offset)
+			if length < self.NLMSGHDR.size:
+				break
+			payload = offset + self.NLMSGHDR.size
+			if msgType in (self.RTM_NEWADDR, self.RTM_DELADDR) and payload + self.IFADDRMSG.size <= len(data):
+				if self.IFADDRMSG.unpack_from(data, payload)[3] == self.RT_SCOPE_UNIVERSE:
+					self._log.debug('Address change event')
+					return True
+			elif msgType in (self.RTM_NEWROUTE, self.RTM_DELROUTE) and payload + self.RTMSG.size <= len(data):
+				if self.RTMSG.unpack_from(data, payload)[1] == 0:
+					self._log.debug('Default route change event')
+					return True
+			# Messages are aligned to 4 bytes
+			offset += (length + 3) & ~3
+		return False
+
+	def close(self):
+		if self.netlink:
+			self.netlink.close()
+		self.wakeUpReader.close()
+		self.wakeUpWriter.close()
+
+
+class RunLock:
+	''' Prevents overlapping runs (e.g. cron starting a run while the previous one is waiting for a slow server),
+	that would update the same domains and overwrite each other's status. While a run is in progress, a single
+	following run waits for it to end and the others are skipped: so at most two processes are alive '''
+
+	def __init__(self, path):
+		self.path = path
+		self.lockFile = None
+
+	def acquire(self, wait, daemon=False):
+		''' Returns True if the lock has been acquired. If already locked and wait is True, waits for
+		the lock to be released, unless another process is already waiting for it or the lock is held by
+		a daemon (that never releases it) '''
+		lockFile = open(self.path + '.lock', 'a')
+		try:
+			fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			if not wait or not self.waitTurn(lockFile):
+				lockFile.close()
+				return False
+		# Tells the waiting processes who is holding the lock
+		lockFile.truncate(0)
+		lockFile.write('{} {}\n'.format('daemon' if daemon else 'run', os.getpid()))
+		lockFile.flush()
+		self.lockFile = lockFile
+		return True
+
+	def waitTurn(self, lockFile):
+		''' Waits for the lock, if no other process is waiting for it. Returns False otherwise '''
+		with open(self.path + '.queue', 'a') as queueFile:
+			try:
+				fcntl.flock(queueFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except BlockingIOError:
+				logging.info('Another run is already waiting for the previous one to end')
+				# The waiting run will check the IP again: no need for another one
+				return False
+			logging.info('The previous run is still running, waiting for it to end')
+			# Polling, to notice a daemon started meanwhile
+			while True:
+				if self.heldByDaemon():
+					logging.info('The lock is held by a daemon, that runs until stopped')
+					return False
+				try:
+					fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+					return True
+				except BlockingIOError:
+					time.sleep(RUN_LOCK_POLL_SECONDS)
+
+	def heldByDaemon(self):
+		try:
+			with open(self.path + '.lock', 'r') as f:
+				return f.read().startswith('daemon')
+		except OSError:
+			return False
+
+	def release(self):
+		''' Closing the file releases the lock '''
+		if self.lockFile:
+			self.lockFile.truncate(0)
+			self.lockFile.close()
+			self.lockFile = None
 
 
 class Status:
@@ -188,32 +853,87 @@ class Status:
 		try:
 			with open(STATUS_FILE, 'r') as openfile:
 				self.status = json.load(openfile)
-		except FileNotFoundError:
+		except (FileNotFoundError, ValueError) as e:
+			if isinstance(e, ValueError):
+				# Half written by a version not writing it atomically
+				logging.error('Ignoring corrupted status file {}: {}'.format(STATUS_FILE, e))
 			self.status =  {
 				'lastRun': None,
 				'lastRunSuccess': None,
 				'lastUpdate': None,
 				'lastIpAddr': None,
 			}
+		self.status.setdefault('lastIpv6Addr', None)
+		self.status.setdefault('domains', {})	# key-value, section name : state of its last update (see setDomainResult)
 
 	def save(self, success, updated):
+		self.setRunResult(success, updated)
+		self.write()
+
+	def setRunResult(self, success, updated):
 		self.status['lastRun'] = str(datetime.datetime.now())
 		self.status['lastRunSuccess'] = success
 		if updated:
 			self.status['lastUpdate'] = str(datetime.datetime.now())
+
+	def write(self):
 		jo = json.dumps(self.status)
-		with open(STATUS_FILE, "w") as outfile:
+		# Written to a temporary file and renamed, so the status file is never found half written
+		tmpPath = STATUS_FILE + '.new'
+		with open(tmpPath, "w") as outfile:
 			outfile.write(jo)
+			outfile.flush()
+			os.fsync(outfile.fileno())
+		os.replace(tmpPath, STATUS_FILE)
 
 	def setIp(self, ip):
-		self.status['lastIpAddr'] = ip
+		self.status['lastIpAddr'], self.status['lastIpv6Addr'] = ip
 
 	def getIp(self):
-		return self.status['lastIpAddr']
+		return (self.status['lastIpAddr'], self.status['lastIpv6Addr'])
+
+	def getDomain(self, name):
+		return self.status['domains'].get(name)
+
+	def setDomainResult(self, name, config, ip, result, nextRetry, failures=0):
+		''' Records the result of the last update of a domain: the settings fingerprint, the address the domain points to,
+		the result code, the time of the next retry (if failed with a temporary error) and the consecutive failures '''
+		self.status['domains'][name] = {
+			'config': config,
+			'ip': list(ip) if ip else None,
+			'result': result,
+			'nextRetry': nextRetry,
+			'failures': failures,
+			'time': time.time(),
+		}
+
+	def isDomainUpToDate(self, name, config, ip):
+		state = self.getDomain(name)
+		if state is None and self.status['lastRunSuccess'] and self.status['lastIpAddr']:
+			# Status saved by a previous version: all the domains were updated to the last address
+			return ip == (self.status['lastIpAddr'], self.status['lastIpv6Addr'] if ip[1] else None)
+		return state is not None and state['config'] == config and state['result'] == 'good' and state['ip'] == list(ip)
+
+	def getNextRetry(self, sections, now):
+		''' Returns the time of the first future retry of a failed domain among the given sections, or None '''
+		retries = [
+			state['nextRetry'] for name, state in self.status['domains'].items()
+			if name in sections and state['nextRetry'] is not None and state['nextRetry'] > now
+		]
+		return min(retries) if retries else None
 
 	def print(self):
 		for k in self.status:
+			if k == 'domains':
+				continue
 			print('{}: {}'.format(k, self.status[k]))
+		for name, state in self.status['domains'].items():
+			print('{}: {} ({}{})'.format(
+				name,
+				', '.join(ip for ip in state['ip'] if ip) if state['ip'] else None,
+				state['result'],
+				', retry after {}'.format(datetime.datetime.fromtimestamp(state['nextRetry'])) if state['nextRetry'] else ''
+			))
 
 
 class Settings:
@@ -232,6 +952,25 @@ class Settings:
 
 		## Domain to update
 		self.domain = self.getStr(name, 'DOMAIN', False)
+		## Addresses to update: IPv4 (A record, myip) and IPv6 (AAAA record, myipv6)
+		self.ipv4 = self.getBoolean(name, 'IPV4', True)
+		self.ipv6 = self.getBoolean(name, 'IPV6', False)
+		## Update together (with a single request) the domains with the same server, credentials and addresses
+		self.batch = self.getBoolean(name, 'BATCH', False)
+
+		## Max concurrent requests to the same server (to respect the provider limits)
+		self.maxParallelPerServer = self.getInt(name, 'MAX_PARALLEL_PER_SERVER', 2)
+		## Seconds to wait for the connection to the server and for its response
+		self.connectTimeout = self.getFloat(name, 'CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT)
+		self.readTimeout = self.getFloat(name, 'READ_TIMEOUT', DEFAULT_READ_TIMEOUT)
+
+	def filterIp(self, ip):
+		''' Returns the addresses (ipv4, ipv6) of ip to update for this domain: the disabled ones are None '''
+		return (ip[0] if self.ipv4 else None, ip[1] if self.ipv6 else None)
+
+	def fingerprint(self):
+		''' Identifies the settings affecting the update result: when they change, the previous result is not valid anymore '''
+		return hashlib.sha256('\n'.join(str(x) for x in (self.ddserver, self.dduser, self.ddpass, self.domain)).encode()).hexdigest()[:16]
 
 	def getStr(self, name, key, defaultValue):
 		try:
@@ -239,6 +978,18 @@ class Settings:
 		except configparser.NoOptionError:
 			return defaultValue
 
+	def getInt(self, name, key, defaultValue):
+		val = self.getStr(name, key, None)
+		if val is None:
+			return defaultValue
+		return int(val)
+
+	def getFloat(self, name, key, defaultValue):
+		val = self.getStr(name, key, None)
+		if val is None:
+			return defaultValue
+		return float(val)
+
 	def getBoolean(self, name, key, defaultValue):
 		try:
 			return self.config.getboolean(name, key)
@@ -258,6 +1009,7 @@ if __name__ == '__main__':
 	parser.add_argument('-q', '--quiet', action='store_true', help="suppress non-essential output")
 	parser.add_argument('-f', '--force', action='store_true', help="force update")
 	parser.add_argument('-s', '--status', action='store_true', help="print current status and exit doing nothing")
+	parser.add_argument('-D', '--daemon', action='store_true', help="keep running, updating the domains as soon as the network\nconfiguration changes (or every POLL_INTERVAL seconds)")
 	args = parser.parse_args()
 
 	if args.quiet:
@@ -272,7 +1024,9 @@ if __name__ == '__main__':
 
 	try:
 		main = Main(args.configFile)
-		if not main.run(args.force, args.status):
+		if args.daemon and not args.status:
+			main.daemon(args.force)
+		elif not main.run(args.force, args.status):
 			sys.exit(2)
 	except Exception as e:
 		logging.critical(traceback.format_exc())
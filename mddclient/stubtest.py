@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+""" @package docstring
+Mddclient stub test
+
+Runs mddclient against local stub servers, to check it without touching any real DNS record:
+- a stub dyndns2 server, answering both the update requests and the checkip requests (with an IP
+  address that can be changed during the test)
+- a stub DNS server, answering the A queries from a fixed zone
+
+Scenarios:
+- daemon: starts mddclient with --daemon, changes the IP and simulates a network event sending SIGUSR1,
+  then checks the domain is updated with the new IP (and only after the event)
+- verify-dns: runs mddclient with VERIFY_DNS=True, with a domain already pointing to the current IP and
+  another one pointing to an old IP, then checks only the second one is updated
+
+Every scenario runs mddclient in its own process, with the status file in a temporary directory.
+
+Usage:
+python3 stubtest.py                       # runs all the scenarios, exits with 1 if any fails
+python3 stubtest.py --scenarios daemon    # runs only some scenarios
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import time
+import signal
+import struct
+import tempfile
+import threading
+import subprocess
+import socketserver
+import http.server
+import urllib.parse
+
+
+NAME = 'stubtest'
+DESCRIPTION = 'Runs mddclient against local stub dyndns2 and DNS servers'
+SCENARIOS = ['daemon', 'verify-dns']
+# Global addresses, as mddclient refuses the private ones
+FIRST_IP = '1.2.3.4'
+SECOND_IP = '1.2.3.5'
+OLD_IP = '5.6.7.8'
+# Max seconds to wait for an update request
+UPDATE_TIMEOUT_SECONDS = 10
+
+
+class Main:
+
+	def __init__(self, args):
+		self.args = args
+
+	def run(self):
+		''' Runs the scenarios and prints the results. Returns False if any failed '''
+		ok = True
+		for scenario in self.args.scenarios:
+			with tempfile.TemporaryDirectory() as tmpDir:
+				server = StubDyndnsServer()
+				dns = StubDnsServer({ 'current.test': FIRST_IP, 'stale.test': OLD_IP })
+				try:
+					error = getattr(self, 'scenario' + scenario.title().replace('-', ''))(tmpDir, server, dns)
+				except Exception as e:
+					error = 'unexpected error: {}'.format(e)
+				finally:
+					server.shutdown()
+					dns.shutdown()
+			print('{:<12} {}'.format(scenario, 'FAIL: ' + error if error else 'OK'))
+			ok = ok and not error
+		return ok
+
+	def scenarioDaemon(self, tmpDir, server, dns):
+		''' Returns the error string, or None if succeeded '''
+		configPath = self.writeConfig(tmpDir, server, [
+			'POLL_INTERVAL=3600',
+			'DEBOUNCE=0.2',
+			'[current]',
+			'DOMAIN=current.test',
+		])
+		proc = self.startMddclient(tmpDir, configPath, daemon=True)
+		try:
+			if not server.waitUpdate('current.test', FIRST_IP):
+				return 'domain not updated at startup'
+
+			# Without network events the IP is not checked again before POLL_INTERVAL
+			server.ip = SECOND_IP
+			time.sleep(1)
+			if server.updates[-1] != ('current.test', FIRST_IP):
+				return 'domain updated without any network event'
+
+			proc.send_signal(signal.SIGUSR1)
+			if not server.waitUpdate('current.test', SECOND_IP):
+				return 'domain not updated after the network event'
+		finally:
+			proc.terminate()
+			proc.wait(UPDATE_TIMEOUT_SECONDS)
+		if proc.returncode != 0:
+			return 'mddclient exited with code {}'.format(proc.returncode)
+
+	def scenarioVerifyDns(self, tmpDir, server, dns):
+		''' Returns the error string, or None if succeeded '''
+		configPath = self.writeConfig(tmpDir, server, [
+			'VERIFY_DNS=True',
+			'RESOLVER=127.0.0.1:{}'.format(dns.port),
+			'[current]',
+			'DOMAIN=current.test',
+			'[stale]',
+			'DOMAIN=stale.test',
+		])
+		proc = self.startMddclient(tmpDir, configPath, daemon=False)
+		proc.wait(UPDATE_TIMEOUT_SECONDS)
+		if proc.returncode != 0:
+			return 'mddclient exited with code {}'.format(proc.returncode)
+		if server.updates != [ ('stale.test', FIRST_IP) ]:
+			return 'expected only stale.test to be updated, got {}'.format(server.updates)
+		if dns.queries < 2:
+			return 'expected both the domains to be resolved, got {} queries'.format(dns.queries)
+
+	def writeConfig(self, tmpDir, server, lines):
+		path = os.path.join(tmpDir, 'mddclient.cfg')
+		with open(path, 'w') as f:
+			f.write('\n'.join([
+				'[DEFAULT]',
+				'SERVER=127.0.0.1:{}'.format(server.port),
+				'LOGIN=user',
+				'PASSWORD=password',
+				'IP_SOURCES=http',
+				'CHECKIP_URLS=http://127.0.0.1:{}/checkip'.format(server.port),
+			] + lines) + '\n')
+		return path
+
+	def startMddclient(self, tmpDir, configPath, daemon):
+		cmd = [ sys.executable, os.path.abspath(__file__), '--mddclient', configPath, os.path.join(tmpDir, 'mddclient.tmp') ]
+		if daemon:
+			cmd.append('--daemon')
+		return subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=None if self.args.verbose else subprocess.DEVNULL)
+
+
+def runMddclient(configPath, statusPath, daemon):
+	''' Internal: runs mddclient in this process, with the status in statusPath and the updates sent over http '''
+	import logging
+	logging.basicConfig(level=logging.INFO)
+	sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+	import mddclient
+	mddclient.STATUS_FILE = statusPath
+	mddclient.DDCLIENT2_REQUEST_ADDR = 'http://{}/nic/update'
+	# Stopped by SIGTERM like by systemd
+	signal.signal(signal.SIGTERM, signal.SIG_DFL)
+	main = mddclient.Main(configPath)
+	if daemon:
+		main.daemon(False)
+		return True
+	return main.run(False, False)
+
+
+class StubDyndnsServer:
+	''' A minimal dyndns2 server, listening on a random local port: records the update requests and answers
+	the checkip requests with the IP address in the ip attribute '''
+
+	def __init__(self):
+		stub = self
+		self.ip = FIRST_IP
+		self.updates = []	# list of tuples (hostname, ip), in arrival order
+		self.updated = threading.Condition()
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+
+			def do_GET(self):
+				url = urllib.parse.urlsplit(self.path)
+				if url.path == '/checkip':
+					body = 'Current IP Address: {}'.format(stub.ip)
+				else:
+					query = urllib.parse.parse_qs(url.query)
+					ip = query['myip'][0]
+					with stub.updated:
+						for hostname in query['hostname'][0].split(','):
+							stub.updates.append((hostname, ip))
+						stub.updated.notify_all()
+					body = 'good {}'.format(ip)
+				self.send_response(200)
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body.encode())
+
+			def log_message(self, format, *args):
+				pass
+
+		self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+		self.server.daemon_threads = True
+		self.port = self.server.server_address[1]
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+	def waitUpdate(self, hostname, ip):
+		''' Waits for the update of hostname to ip, returns False if not received in time '''
+		with self.updated:
+			return self.updated.wait_for(lambda: (hostname, ip) in self.updates, UPDATE_TIMEOUT_SECONDS)
+
+	def shutdown(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+
+class StubDnsServer:
+	''' A minimal DNS server, listening on a random local UDP port: answers the A queries for the names in
+	the zone (key-value, name : IPv4 address), and NXDOMAIN for any other query '''
+
+	def __init__(self, zone):
+		stub = self
+		self.zone = zone
+		self.queries = 0
+
+		class Handler(socketserver.BaseRequestHandler):
+			def handle(self):
+				data, sock = self.request
+				stub.queries += 1
+				# Header (12 bytes), then the question: name labels, type and class
+				offset = 12
+				labels = []
+				while data[offset]:
+					labels.append(data[offset + 1:offset + 1 + data[offset]].decode())
+					offset += data[offset] + 1
+				qtype = struct.unpack_from('>H', data, offset + 1)[0]
+				question = data[12:offset + 5]
+				ip = stub.zone.get('.'.join(labels))
+				if ip is None:
+					# Response, recursion desired and available, NXDOMAIN
+					sock.sendto(data[:2] + struct.pack('>HHHHH', 0x8183, 1, 0, 0, 0) + question, self.client_address)
+					return
+				answer = b''
+				if qtype == 1:
+					# Pointer to the name in the question, type A, class IN, TTL, address
+					answer = b'\xc0\x0c' + struct.pack('>HHLH', 1, 1, 300, 4) + bytes(int(x) for x in ip.split('.'))
+				sock.sendto(data[:2] + struct.pack('>HHHHH', 0x8180, 1, 1 if answer else 0, 0, 0) + question + answer, self.client_address)
+
+		self.server = socketserver.ThreadingUDPServer(('127.0.0.1', 0), Handler)
+		self.server.daemon_threads = True
+		self.port = self.server.server_address[1]
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+	def shutdown(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		prog = NAME + '.py',
+		description = NAME + '\n' + DESCRIPTION,
+		formatter_class = argparse.RawTextHelpFormatter
+	)
+	parser.add_argument('--scenarios', nargs='+', default=SCENARIOS, choices=SCENARIOS, help="scenarios to run")
+	parser.add_argument('-v', '--verbose', action='store_true', help="print the mddclient logs")
+	parser.add_argument('--mddclient', nargs=2, help=argparse.SUPPRESS)
+	parser.add_argument('--daemon', action='store_true', help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.mddclient:
+		# Internal: runs mddclient with the given config and status file
+		sys.exit(0 if runMddclient(args.mddclient[0], args.mddclient[1], args.daemon) else 2)
+
+	sys.exit(0 if Main(args).run() else 1)